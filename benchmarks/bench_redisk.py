@@ -0,0 +1,197 @@
+# Benchmarks of the read and write paths of redisk.
+#
+#   python benchmarks/bench_redisk.py --backend redis --keys 10000 --value-size lognormal:1024:1 --output results.json
+#
+# The redis backend needs a running redis-server; fakeredis and sqlite run in
+# process. Every workload reports ops/s, p50/p99 latency and the bytes read
+# from the table files as JSON, so that results of releases can be compared.
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redisk import Table, Redisk
+from redisk.store import RedisStore
+
+def parse_sizes(spec):
+    # fixed:<bytes>, uniform:<min>:<max> or lognormal:<median>:<sigma>
+    parts = spec.split(':')
+    if parts[0] == 'fixed': return lambda rng, n: np.full(n, int(parts[1]), dtype=np.int64)
+    if parts[0] == 'uniform': return lambda rng, n: rng.integers(int(parts[1]), int(parts[2]) + 1, size=n)
+    if parts[0] == 'lognormal':
+        return lambda rng, n: np.maximum(1, rng.lognormal(np.log(float(parts[1])), float(parts[2]), size=n)).astype(np.int64)
+    raise Exception('Value size distribution {0} is not supported! Use fixed, uniform or lognormal.'.format(spec))
+
+def open_table(args, base_dir):
+    store = None
+    if args.backend == 'fakeredis':
+        import fakeredis
+        store = RedisStore(client=fakeredis.FakeStrictRedis())
+    elif args.backend == 'sqlite':
+        store = 'sqlite'
+    tbl = Table('bench', base_dir, args.db, args.host, port=args.port, unix_socket_path=args.unix_socket,
+                store=store, use_mmap=args.mmap, compression=args.compression)
+    # counts the bytes read from the table files
+    read = tbl.read
+    def counting_read(start, length):
+        tbl.bytes_read += int(length)
+        return read(start, length)
+    tbl.bytes_read = 0
+    tbl.read = counting_read
+    return tbl
+
+class Workload(object):
+    def __init__(self, name, tbl):
+        self.name = name
+        self.tbl = tbl
+        self.latencies = []
+
+    def __enter__(self):
+        self.bytes_read = self.tbl.bytes_read
+        self.start = time.perf_counter()
+        return self
+
+    def run(self, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+    def result(self, items_per_op=1):
+        latencies = np.array(self.latencies)*1000
+        return {'name': self.name, 'ops': len(self.latencies), 'items_per_op': items_per_op,
+                'ops_per_sec': len(self.latencies)/self.elapsed if self.elapsed > 0 else None,
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'bytes_read': self.tbl.bytes_read - self.bytes_read}
+
+def bench_set_get(db, args, rng, sizes):
+    keys = ['v{0}'.format(i) for i in range(args.keys)]
+    values = [os.urandom(int(size)//2).hex() for size in sizes]
+    results = []
+    with Workload('set', db.tbl) as w:
+        for key, value in zip(keys, values):
+            w.run(db.set, key, value)
+        db.flush()
+    results.append(w.result())
+
+    order = rng.permutation(args.keys)
+    with Workload('get', db.tbl) as w:
+        for i in order:
+            w.run(db.get, keys[i])
+    results.append(w.result())
+
+    with Workload('batched_get', db.tbl) as w:
+        for i in range(0, args.keys, args.batch_size):
+            w.run(db.batched_get, [keys[j] for j in order[i:i + args.batch_size]])
+    results.append(w.result(args.batch_size))
+
+    with Workload('set_many', db.tbl) as w:
+        for i in range(0, args.keys, args.batch_size):
+            w.run(db.set_many, list(zip(keys[i:i + args.batch_size], values[i:i + args.batch_size])))
+        db.flush()
+    results.append(w.result(args.batch_size))
+    return results
+
+def bench_append(db, args, rng):
+    results = []
+    chains = max(1, args.keys//args.chain_length)
+    with Workload('append', db.tbl) as w:
+        for i in range(chains):
+            for j in range(args.chain_length):
+                w.run(db.append, 'chain{0}'.format(i), j, args.chunk_length)
+    results.append(w.result())
+    with Workload('append_flush', db.tbl) as w:
+        w.run(db.flush)
+    results.append(w.result())
+    with Workload('get_chain', db.tbl) as w:
+        for i in range(chains):
+            w.run(db.get, 'chain{0}'.format(i))
+    results.append(w.result())
+    return results
+
+def bench_numpy(db, args, rng):
+    results = []
+    for size in args.array_sizes:
+        keys = ['array{0}/{1}'.format(size, i) for i in range(args.arrays)]
+        for key in keys:
+            db.set(key, rng.random(max(1, size//8)))
+        db.flush()
+        with Workload('numpy_get_{0}'.format(size), db.tbl) as w:
+            for key in keys:
+                w.run(db.get, key)
+        results.append(w.result())
+    return results
+
+def bench_references(db, args, rng):
+    groups = max(1, args.keys//args.group_size)
+    for i in range(groups):
+        for j in range(args.group_size):
+            db.set('ref{0}/{1}'.format(i, j), 'value{0}'.format(j), reference_id=i)
+    db.flush()
+    with Workload('get_with_reference', db.tbl) as w:
+        for i in range(groups):
+            w.run(db.get_with_reference, i)
+    return [w.result(args.group_size)]
+
+workloads = ['set_get', 'append', 'numpy', 'references']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the read and write paths of redisk.')
+    parser.add_argument('--backend', default='redis', choices=['redis', 'fakeredis', 'sqlite'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--db', type=int, default=15, help='redis database which is flushed by the benchmark')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--value-size', default='lognormal:1024:1', help='fixed:<bytes>, uniform:<min>:<max> or lognormal:<median>:<sigma>')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--chain-length', type=int, default=1000)
+    parser.add_argument('--chunk-length', type=int, default=100)
+    parser.add_argument('--arrays', type=int, default=100)
+    parser.add_argument('--array-sizes', type=int, nargs='+', default=[1 << 10, 1 << 16, 1 << 20])
+    parser.add_argument('--group-size', type=int, default=100)
+    parser.add_argument('--compression', default=None)
+    parser.add_argument('--mmap', action='store_true')
+    parser.add_argument('--workloads', nargs='+', default=workloads, choices=workloads)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help='JSON output file, - for stdout')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    base_dir = tempfile.mkdtemp(prefix='redisk-bench-')
+    db = Redisk(open_table(args, base_dir))
+    db.tbl.store.flushdb()
+    results = []
+    try:
+        if 'set_get' in args.workloads: results += bench_set_get(db, args, rng, parse_sizes(args.value_size)(rng, args.keys))
+        if 'append' in args.workloads: results += bench_append(db, args, rng)
+        if 'numpy' in args.workloads: results += bench_numpy(db, args, rng)
+        if 'references' in args.workloads: results += bench_references(db, args, rng)
+    finally:
+        db.delete_db()
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    report = {'config': vars(args),
+              'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                              'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': results}
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(report, out, indent=2)
+    out.write('\n')
+    if out is not sys.stdout: out.close()
+    return report
+
+if __name__ == '__main__':
+    main()
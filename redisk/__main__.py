@@ -0,0 +1,52 @@
+from __future__ import print_function
+
+import sys
+import argparse
+import ujson
+import numpy as np
+
+from redisk.core import Table, Redisk
+from redisk.bulk import load, export, read_file
+
+def to_json(value):
+    if isinstance(value, np.ndarray): return value.tolist()
+    if isinstance(value, bytes): return value.decode('latin1')
+    return value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='redisk', description='Bulk loads and exports redisk tables.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    for command, path_help in [('load', 'input file (.jsonl, .csv or .npy)'), ('export', 'output .jsonl file, - for stdout')]:
+        p = commands.add_parser(command)
+        p.add_argument('name', help='table name')
+        p.add_argument('base_dir', help='directory of the table files')
+        p.add_argument('path', help=path_help)
+        p.add_argument('--processes', type=int, default=None, help='pool size, 0 runs in this process (default: all cores)')
+        p.add_argument('--batch-size', type=int, default=1000)
+        p.add_argument('--store', default='redis', choices=['redis', 'sqlite'])
+        p.add_argument('--host', default='localhost')
+        p.add_argument('--port', type=int, default=6379)
+        p.add_argument('--unix-socket', default=None)
+        p.add_argument('--db', type=int, default=0)
+        if command == 'load':
+            p.add_argument('--compression', default=None)
+            p.add_argument('--key-field', default='key', help='key field of .jsonl and .csv inputs')
+    args = parser.parse_args(argv)
+
+    tbl = Table(args.name, args.base_dir, args.db, args.host, port=args.port,
+                unix_socket_path=args.unix_socket, store=args.store)
+    db = Redisk(tbl)
+    if args.command == 'load':
+        kwargs = {} if args.path.endswith('.npy') else {'key_field': args.key_field}
+        count = load(db, read_file(args.path, **kwargs), args.processes, args.batch_size, args.compression)
+        print('Loaded {0} values into {1}'.format(count, args.name), file=sys.stderr)
+    else:
+        out = sys.stdout if args.path == '-' else open(args.path, 'w')
+        for key, value in export(db, args.processes, args.batch_size):
+            out.write(ujson.dumps({'key': key, 'value': to_json(value)}) + '\n')
+        if out is not sys.stdout: out.close()
+    db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import asyncio
+
+from os.path import join
+from collections import OrderedDict
+
+import redis.asyncio
+
+from redisk.core import Table, Redisk
+from redisk.util import plan_reads
+
+class AsyncTable(object):
+    def __init__(self, name, base_dir, db_id=0, host='localhost', executor=None, **kwargs):
+        # the synchronous table owns the files and the metadata format;
+        # metadata is sent through the asyncio client and file access runs
+        # in the executor (the default executor of the loop if None)
+        self.tbl = Table(name, base_dir, db_id, host, **kwargs)
+        self.name = name
+        # embedded stores have no asyncio client and run in the executor
+        self.db = None
+        if self.tbl.store.connection_kwargs is not None:
+            self.db = redis.asyncio.StrictRedis(**self.tbl.store.connection_kwargs)
+        self.executor = executor
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def get(self, key):
+        if self.db is None: return await self.run(self.tbl.get, key)
+        return self.tbl.decode_metadata(await self.db.get(join(self.name, key)))
+
+    async def get_many(self, keys):
+        if len(keys) == 0: return []
+        if self.db is None: return await self.run(self.tbl.get_many, keys)
+        values = await self.db.mget([join(self.name, key) for key in keys])
+        return [self.tbl.decode_metadata(value) for value in values]
+
+    async def write(self, records, register=False):
+        # the metadata is published by the executor thread while it still
+        # holds the table lock, once the bytes are written (and synced unless
+        # the fsync policy of the table is none), with the registry entries
+        # of the keys if register is set
+        if register: self.tbl.unregistered.update([record[0] for record in records])
+        await self.run(self.tbl.writer.write, records, self.tbl.writer.fsync != 'none', self.tbl.set_many)
+
+    def read_ranges(self, ranges, max_gap):
+        # positional reads do not move the shared file offset, so many reads
+        # can be in flight on the executor at once
+        values = [None]*len(ranges)
+        for start, end, indices in plan_reads(ranges, max_gap):
+            buffer = self.tbl.pread(start, end - start)
+            for i in indices:
+                offset = ranges[i][0] - start
+                values[i] = buffer[offset:offset + ranges[i][1]]
+        return values
+
+    async def read_many(self, ranges, max_gap=4096):
+        return await self.run(self.read_ranges, ranges, max_gap)
+
+    async def register(self, keys):
+        await self.run(self.tbl.register, keys)
+
+    async def key_col_iter(self):
+        # walks the key registry of the table
+        if self.db is None:
+            for key, col in await self.run(list, self.tbl.key_col_iter()):
+                yield key, col
+            return
+        async for key, score in self.db.zscan_iter(self.tbl.index_key()):
+            yield key.decode('utf8'), None
+        for col in sorted(await self.db.smembers('{0}:columns'.format(self.name))):
+            col = col.decode('utf8')
+            async for key, score in self.db.zscan_iter(self.tbl.index_key(col)):
+                yield key.decode('utf8'), col
+
+    async def close(self):
+        await self.run(self.tbl.writer.close)
+        if self.db is not None: await self.db.aclose()
+
+
+class AsyncRedisk(object):
+    def __init__(self, tbl, max_read_gap=4096):
+        self.tbl = tbl
+        self.max_read_gap = max_read_gap
+        # the handlers of a synchronous instance do the (de)serialization
+        self.sync_db = Redisk(tbl.tbl, max_read_gap)
+        self.type2processor = self.sync_db.type2processor
+
+    async def get(self, key, col=None):
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        values = await self.batched_get([key])
+        return values[0]
+
+    async def batched_get(self, keys):
+        data = [None]*len(keys)
+        metadata = await self.tbl.get_many(keys)
+        ranges = []
+        positions = []
+        pointer_keys = []
+        for i, values in enumerate(metadata):
+            if values is None: continue
+            start, length, type_value, pointers, vargs, codec = values
+            ranges.append((int(start), int(length)))
+            positions.append(i)
+            for p in pointers:
+                pointer_keys.append((i, p))
+
+        raw = await self.tbl.read_many(ranges, self.max_read_gap)
+        groups = OrderedDict()
+        for i, value in zip(positions, raw):
+            start, length, type_value, pointers, vargs, codec = metadata[i]
+            p = self.type2processor[type_value]
+            indices, values, batch_vargs = groups.setdefault(p, ([], [], []))
+            indices.append(i)
+            values.append(p.decompress(value, vargs, codec))
+            batch_vargs.append(vargs)
+
+        for p, (indices, values, batch_vargs) in groups.items():
+            for i, value in zip(indices, p.batched_decode(values, batch_vargs)):
+                data[i] = value
+
+        if len(pointer_keys) > 0:
+            chunks = await self.batched_get([p for i, p in pointer_keys])
+            for (i, p), chunk in zip(pointer_keys, chunks):
+                if chunk is not None: data[i] += chunk
+        return data
+
+    async def set(self, key, value, col=None, compression=None):
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        await self.set_many([(key, value)], compression)
+
+    async def set_many(self, items, compression=None):
+        if isinstance(items, dict): items = items.items()
+        records = []
+        for key, value in items:
+            p = self.type2processor[type(value)]
+            value, type_value, args = p.serialize(value)
+            value, codec = p.compress(value, args, compression)
+            records.append((key, value, type_value, args, codec))
+        if len(records) > 0:
+            await self.tbl.write(records, register=True)
+
+    async def exists(self, key):
+        return (await self.tbl.get(key)) is not None
+
+    async def key_col_pairs(self):
+        async for key, col in self.tbl.key_col_iter():
+            yield key, col
+
+    async def close(self):
+        self.sync_db.flush()
+        await self.tbl.close()
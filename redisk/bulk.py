@@ -0,0 +1,127 @@
+import os
+import csv
+import ujson
+import numpy as np
+import multiprocessing
+
+from os.path import splitext
+from collections import deque
+
+from redisk.core import Table, Redisk, make_processors, serialize_records
+
+# state of the pool processes which is set up by the initializers
+worker = {}
+
+def init_serializer():
+    worker['type2processor'] = make_processors(None)[1]
+
+def serialize_batch(task):
+    items, compression = task
+    return serialize_records(worker['type2processor'], items, compression)
+
+def init_reader(open_args):
+    worker['db'] = Redisk(Table(**open_args))
+
+def read_batch(keys):
+    return list(zip(keys, worker['db'].batched_get(keys)))
+
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0: yield batch
+
+def imap_bounded(pool, func, tasks, window):
+    # like Pool.imap, but with at most window tasks in flight so that large
+    # inputs are never read into memory as a whole
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window: yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def run_batches(func, tasks, processes, initializer=None, initargs=()):
+    # processes=0 runs the batches in this process
+    if processes == 0:
+        if initializer is not None: initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+    if processes is None: processes = os.cpu_count()
+    pool = multiprocessing.Pool(processes, initializer, initargs)
+    try:
+        for result in imap_bounded(pool, func, tasks, 2*processes):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def load(db, items, processes=None, batch_size=1000, compression=None):
+    # writes (key, value) pairs with batched appends while the values are
+    # serialized and compressed in a pool of processes; returns the number
+    # of written values
+    if isinstance(items, dict): items = items.items()
+    # the pool processes have no table to take the compression from
+    if compression is None: compression = db.tbl.compression or 'none'
+    count = 0
+    tasks = ((batch, compression) for batch in batches(items, batch_size))
+    for records in run_batches(serialize_batch, tasks, processes, init_serializer):
+        db.set_records(records)
+        count += len(records)
+    db.flush()
+    return count
+
+def export(db, processes=None, batch_size=1000):
+    # yields the (key, value) pairs of all keys of the table in offset order;
+    # the batches are read and decoded in a pool of processes which open the
+    # table themselves
+    assert db.tbl.open_args is not None, 'Tables with a custom store cannot be opened by other processes!'
+    db.flush()
+    extents = []
+    for batch in batches((key if col is None else '{0}/{1}'.format(key, col) for key, col in db.tbl.key_col_iter()), batch_size):
+        for key, values in zip(batch, db.tbl.get_many(batch)):
+            if values is not None: extents.append((values[0], key))
+    extents.sort()
+    tasks = batches((key for start, key in extents), batch_size)
+    for pairs in run_batches(read_batch, tasks, processes, init_reader, (db.tbl.open_args,)):
+        for key, value in pairs:
+            yield key, value
+
+def read_jsonl(path, key_field='key', value_field='value'):
+    # every line is an object with a key; the value field is the value of the
+    # key and all other fields are columns of the key
+    with open(path) as f:
+        for line in f:
+            if len(line.strip()) == 0: continue
+            row = ujson.loads(line)
+            key = str(row.pop(key_field))
+            for col, value in row.items():
+                if value is None: continue
+                yield (key if col == value_field else '{0}/{1}'.format(key, col)), value
+
+def read_csv(path, key_field='key'):
+    # all fields except the key are columns of the key
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            key = row.pop(key_field)
+            for col, value in row.items():
+                yield '{0}/{1}'.format(key, col), value
+
+def read_npy(path, keys=None):
+    # one value per row; rows are keyed by their index if there are no keys
+    data = np.load(path, mmap_mode='r')
+    for i in range(data.shape[0]):
+        yield (str(i) if keys is None else keys[i]), np.array(data[i])
+
+readers = {'.jsonl': read_jsonl, '.csv': read_csv, '.npy': read_npy}
+
+def read_file(path, **kwargs):
+    ext = splitext(path)[1]
+    if ext not in readers:
+        raise Exception('Input {0} is not supported! Supported inputs: {1}'.format(path, sorted(readers.keys())))
+    return readers[ext](path, **kwargs)
@@ -0,0 +1,100 @@
+import sys
+import itertools
+import threading
+import numpy as np
+
+from collections import OrderedDict, defaultdict
+
+class LRUCache(object):
+    def __init__(self, max_bytes, admission=None):
+        self.max_bytes = max_bytes
+        # type -> largest value in bytes which is admitted for that type
+        self.admission = admission if admission is not None else {}
+        self.entries = OrderedDict()
+        self.size = 0
+        # reader threads share the cache
+        self.lock = threading.RLock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def get(self, kind, key):
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+            self.hits[kind] += 1
+            self.entries.move_to_end((kind, key))
+        return copy_value(entry[0], entry[2])
+
+    def admits(self, type_value, size):
+        if size > self.max_bytes: return False
+        max_size = self.admission.get(type_value)
+        return max_size is None or size <= max_size
+
+    def put(self, kind, key, value, size, type_value=None):
+        # the cache keeps a copy of the value and hands out copies, so that
+        # callers cannot change the cached value
+        if not self.admits(type_value, size): return
+        nested = is_nested(value)
+        value = copy_value(value, nested)
+        with self.lock:
+            self.pop((kind, key))
+            self.entries[(kind, key)] = (value, size, nested)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, entry_key):
+        with self.lock:
+            entry = self.entries.pop(entry_key, None)
+            if entry is not None: self.size -= entry[1]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.pop(('metadata', key))
+            self.pop(('value', key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': dict(self.hits), 'misses': dict(self.misses),
+                'entries': len(self.entries), 'bytes': self.size}
+
+containers = (list, dict)
+# containers larger than this are sized from a sample of their elements
+sample_size = 64
+
+def is_nested(value):
+    return isinstance(value, dict) or (isinstance(value, list) and any(map(containers.__contains__, map(type, value))))
+
+def copy_value(value, nested=True):
+    # copies lists and dicts down to their immutable elements; lists
+    # without containers only need a shallow copy
+    if isinstance(value, dict): return dict([(k, copy_value(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        if not nested: return list(value)
+        return [copy_value(v) if isinstance(v, containers) else v for v in value]
+    return value
+
+def value_size(value):
+    # approximate memory of a decoded value in bytes
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, (str, bytes, bytearray)): return len(value)
+    if isinstance(value, memoryview): return value.nbytes
+    if isinstance(value, (list, tuple)):
+        step = max(1, len(value)//sample_size)
+        return sys.getsizeof(value) + elements_size(value[::step], len(value))
+    if isinstance(value, dict):
+        step = max(1, len(value)//sample_size)
+        sample = [value_size(k) + value_size(v) for k, v in itertools.islice(value.items(), 0, None, step)]
+        return sys.getsizeof(value) + (sum(sample)*len(value)//len(sample) if len(sample) > 0 else 0)
+    return sys.getsizeof(value)
+
+def elements_size(sample, count):
+    if len(sample) == 0: return 0
+    return sum([value_size(v) for v in sample])*count//len(sample)
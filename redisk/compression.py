@@ -0,0 +1,60 @@
+import bz2
+import lzma
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+
+# the codec id is stored in the metadata of every value; the high bit marks
+# values which were byte shuffled before compression
+SHUFFLE = 0x80
+
+codecs = OrderedDict()
+codecs['zlib'] = (1, zlib.compress, zlib.decompress)
+codecs['lzma'] = (2, lzma.compress, lzma.decompress)
+codecs['bz2'] = (3, bz2.compress, bz2.decompress)
+
+try:
+    import zstandard
+    codecs['zstd'] = (4, lambda value: zstandard.ZstdCompressor().compress(value),
+                      lambda value: zstandard.ZstdDecompressor().decompress(value))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    codecs['lz4'] = (5, lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+id2codec = dict((codec_id, (name, c, d)) for name, (codec_id, c, d) in codecs.items())
+
+def get_codec(name, shuffle=False):
+    if name is None or name == 'none': return 0
+    # fastest installed codec
+    if name == 'auto': name = 'zstd' if 'zstd' in codecs else ('lz4' if 'lz4' in codecs else 'zlib')
+    if name not in codecs:
+        raise Exception('Compression codec {0} is not available! Available codecs: {1}'.format(name, list(codecs.keys())))
+    codec_id = codecs[name][0]
+    return codec_id | SHUFFLE if shuffle else codec_id
+
+def shuffle(value, itemsize):
+    # groups the i-th byte of every item together which makes typed data
+    # such as floats far more compressible
+    return np.frombuffer(value, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+def unshuffle(value, itemsize):
+    return np.frombuffer(value, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+def compress(value, codec_id, itemsize=1):
+    if codec_id == 0: return value
+    if codec_id & SHUFFLE and itemsize > 1: value = shuffle(value, itemsize)
+    return id2codec[codec_id & ~SHUFFLE][1](value)
+
+def decompress(value, codec_id, itemsize=1):
+    if codec_id == 0: return value
+    if codec_id & ~SHUFFLE not in id2codec:
+        raise Exception('Compression codec {0} is not installed!'.format(codec_id & ~SHUFFLE))
+    value = id2codec[codec_id & ~SHUFFLE][2](value)
+    if codec_id & SHUFFLE and itemsize > 1: value = unshuffle(value, itemsize)
+    return value
@@ -3,141 +3,896 @@ from __future__ import unicode_literals
 
 from os.path import join
 
-from redisk.handlers import IntDataHandler, StringDataHandler, ListDataHandler, NumpyDataHandler, DictDataHandler
-from redisk.util import Types
+from redisk.handlers import AbstractDataHandler, IntDataHandler, StringDataHandler, BytesDataHandler, ListDataHandler, NumpyDataHandler, DictDataHandler
+from redisk.util import Types, pack_offset, unpack_offset
+from redisk.writer import AppendWriter
+from redisk.cache import LRUCache, value_size
+from redisk.store import RedisStore, SQLiteStore
+from redisk.metrics import Metrics, timed
 from uuid import uuid4
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import redis
+import numpy as np
 import os
+import mmap
+import threading
+import functools
+import weakref
+import pickle
+import errno
+import struct
 import ujson
 import shutil
 
 types = Types()
 
+# binary metadata record: version, type code, flags, start, length followed by
+# the optional codec, pointer and vargs sections which are present if their
+# flag is set
+METADATA_VERSION = 1
+metadata_header = struct.Struct('<BBBQQ')
+metadata_section = struct.Struct('<I')
+metadata_codec = struct.Struct('<B')
+FLAG_POINTERS = 1
+FLAG_VARGS = 2
+FLAG_CODEC = 4
+FLAG_PACKED_VARGS = 8
+# packed vargs: arrays are a length prefixed dtype, the number of dimensions,
+# the shape and the order; lists are the type code and the count
+metadata_ndim = struct.Struct('<B')
+metadata_list = struct.Struct('<cQ')
+# approximate size of a decoded metadata tuple for the read cache
+metadata_size = 128
+
+# tables and databases of this process, which are reset in the child after a fork
+open_tables = weakref.WeakSet()
+open_dbs = weakref.WeakSet()
+
+def reset_after_fork():
+    for tbl in list(open_tables):
+        tbl.after_fork()
+    for db in list(open_dbs):
+        db.after_fork()
+
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=reset_after_fork)
+
+def open_table(args):
+    return Table(**args)
+
+def retry_removed(func):
+    # a compaction in another process removes the old segments once it has
+    # swapped the offsets; a reader which looked up the metadata before the
+    # swap, but had not opened the segment yet, retries with fresh metadata
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except FileNotFoundError:
+            if self.cache is not None: self.cache.clear()
+            return func(self, *args, **kwargs)
+    return wrapper
+
 class Table(object):
-    def __init__(self, name, base_dir, db_id=0, host='localhost'):
+    def __init__(self, name, base_dir, db_id=0, host='localhost', use_mmap=False,
+                 buffer_size=0, flush_interval=None, fsync='none', fsync_interval=1.0,
+                 compression=None, segment_size=1 << 32, concurrent_writers=False,
+                 port=6379, unix_socket_path=None, store=None, metrics=None):
         self.name = name
-        self.db = redis.StrictRedis(host='localhost', port=6379, db=db_id, decode_responses=True)
+        # appends go to a new segment file once the active one reaches this size
+        self.segment_size = segment_size
+        # codec name from redisk.compression which is used for all values
+        self.compression = compression
+        # arguments which open the same table in another process; stores
+        # passed as objects cannot be reopened
+        self.open_args = None
+        if store is None or isinstance(store, str):
+            self.open_args = dict(name=name, base_dir=base_dir, db_id=db_id, host=host, port=port,
+                                  unix_socket_path=unix_socket_path, use_mmap=use_mmap, buffer_size=buffer_size,
+                                  flush_interval=flush_interval, fsync=fsync, fsync_interval=fsync_interval,
+                                  compression=compression, segment_size=segment_size,
+                                  concurrent_writers=concurrent_writers, store=store,
+                                  metrics=True if metrics is not None else None)
+        # all metadata, sets and indices go through the store: Redis by
+        # default, 'sqlite' for an embedded database next to the table files
+        # or any object with the interface of redisk.store.RedisStore
+        if store is None or store == 'redis': store = RedisStore(host, port, db_id, unix_socket_path)
+        elif store == 'sqlite': store = SQLiteStore(join(base_dir, name + '.sqlite'))
+        self.store = store
+        # counters and latency histograms (redisk.metrics.Metrics); True
+        # creates them and None disables them
+        if metrics is True: metrics = Metrics()
+        self.metrics = metrics
+        self.store.metrics = metrics
         self.read_fhandle = None
+        # read handles and mappings by segment id
+        self.fhandles = {}
+        # True maps all segments, 'sealed' only the immutable ones
+        self.use_mmap = use_mmap
+        self.mmaps = {}
+        self.sealed = set()
+        # guards the creation of handles and mappings by reader threads
+        self.handle_lock = threading.Lock()
         self.write_path = join(base_dir, self.name)
         home = os.environ['HOME']
         self.base_dir = base_dir
         self.make_table_path()
+        self.writer_args = (buffer_size, flush_interval, fsync, fsync_interval, concurrent_writers)
+        self.writer = AppendWriter(self, self.write_path, *self.writer_args)
+        # read cache of the Redisk instance; invalidated whenever metadata is published
+        self.cache = None
+        # keys which are registered when their metadata is published
+        self.unregistered = set()
+        open_tables.add(self)
+
+    def __reduce__(self):
+        # pickles into the arguments of the table; the copy connects on first use
+        if self.open_args is None:
+            raise pickle.PicklingError('Tables with a custom store cannot be pickled!')
+        return open_table, (self.open_args,)
+
+    def after_fork(self):
+        # a child of fork shares the file offsets and sockets of the parent;
+        # handles, mappings, writer and locks are dropped so that the child
+        # opens its own on first use. Buffered writes stay with the parent.
+        self.fhandles = {}
+        self.mmaps = {}
+        self.handle_lock = threading.Lock()
+        self.writer = AppendWriter(self, self.write_path, *self.writer_args)
+        if self.cache is not None: self.cache.lock = threading.RLock()
 
     def make_table_path(self):
         if not os.path.exists(self.base_dir):
             os.makedirs(self.base_dir)
-        if not os.path.exists(join(self.base_dir, self.name)):
+        if not os.path.exists(join(self.base_dir, self.name)) and len(self.list_segment_ids()) == 0:
             with open(join(self.base_dir, self.name), 'a'):
                 os.utime(join(self.base_dir, self.name), None)
         return join(self.base_dir, self.name)
 
+    def segment_path(self, segment_id):
+        # segment 0 is the original table file
+        if segment_id == 0: return self.write_path
+        return '{0}.{1}'.format(self.write_path, segment_id)
+
+    def list_segment_ids(self):
+        segment_ids = []
+        prefix = self.name + '.'
+        for fname in os.listdir(self.base_dir):
+            if fname == self.name: segment_ids.append(0)
+            elif fname.startswith(prefix) and fname[len(prefix):].isdigit():
+                segment_ids.append(int(fname[len(prefix):]))
+        return sorted(segment_ids)
+
+    def segment_ids(self):
+        segment_ids = self.list_segment_ids()
+        return segment_ids if len(segment_ids) > 0 else [0]
+
+    def seal_path(self, segment_id):
+        return self.segment_path(segment_id) + '.sealed'
+
+    def seal(self, segment_id):
+        # a marker file next to the segment; sealed segments are never appended to
+        open(self.seal_path(segment_id), 'a').close()
+
+    def is_marked_sealed(self, segment_id):
+        return os.path.exists(self.seal_path(segment_id))
+
+    def active_segment(self):
+        # the newest segment, unless it is sealed; needs to be called with
+        # the lock of the writer held
+        segment_id = self.segment_ids()[-1]
+        if not self.is_marked_sealed(segment_id): return segment_id
+        return self.claim_segment()
+
+    def claim_segment(self):
+        # creates the next free segment; exclusive creation makes this safe
+        # between processes without a lock
+        segment_id = self.segment_ids()[-1] + 1
+        while True:
+            try:
+                os.close(os.open(self.segment_path(segment_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return segment_id
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+                segment_id += 1
+
+    def get_fhandle(self, segment_id):
+        fhandle = self.fhandles.get(segment_id)
+        if fhandle is None:
+            with self.handle_lock:
+                fhandle = self.fhandles.get(segment_id)
+                if fhandle is None:
+                    fhandle = open(self.segment_path(segment_id), 'rb')
+                    self.fhandles[segment_id] = fhandle
+        return fhandle
+
     def open_connection(self):
         #assert not os.path.exists(join(self.base_dir, self.name + '_lock')), 'Connection to table already open!'
         #with open(join(self.base_dir, self.name + '_lock'), 'a'):
         #    os.utime(join(self.base_dir, self.name), None)
 
-        self.read_fhandle = open(join(self.base_dir, self.name), 'rb+')
+        self.read_fhandle = self.get_fhandle(self.segment_ids()[-1])
         return self.read_fhandle, self.write_path
 
+    def append_bytes(self, records):
+        self.writer.append(records)
+
+    def flush(self):
+        self.writer.flush()
+        self.writer.sync(force=True)
+
+    @timed('phase.io')
+    def read(self, start, length):
+        segment_id, offset = unpack_offset(int(start))
+        length = int(length)
+        if self.metrics is not None: self.metrics.count('io.bytes_read', length)
+        if self.use_mmap is True or (self.use_mmap == 'sealed' and self.is_sealed(segment_id)):
+            end = offset + length
+            mapped = self.mmaps.get(segment_id)
+            if mapped is None or end > len(mapped): mapped = self.remap(segment_id)
+            return memoryview(mapped)[offset:end]
+        return self.read_segment(segment_id, offset, length)
+
+    @timed('phase.io')
+    def pread(self, start, length):
+        # positional read which never maps the segment
+        segment_id, offset = unpack_offset(int(start))
+        if self.metrics is not None: self.metrics.count('io.bytes_read', int(length))
+        return self.read_segment(segment_id, offset, int(length))
+
+    def read_segment(self, segment_id, offset, length):
+        # positional reads do not move a shared file offset, so any number of
+        # threads can read through the same handle
+        fd = self.get_fhandle(segment_id).fileno()
+        value = os.pread(fd, length, offset)
+        if len(value) == length or len(value) == 0: return value
+        # large reads can be returned in parts
+        parts = [value]
+        while length > 0 and len(parts[-1]) > 0:
+            length -= len(parts[-1])
+            offset += len(parts[-1])
+            if length > 0: parts.append(os.pread(fd, length, offset))
+        return b''.join(parts)
+
+    def is_sealed(self, segment_id):
+        # only the newest segment is appended to, unless a roll or a
+        # compaction sealed it
+        if segment_id not in self.sealed and (self.is_marked_sealed(segment_id) or os.path.exists(self.segment_path(segment_id + 1))):
+            self.sealed.add(segment_id)
+        return segment_id in self.sealed
+
+    def segments(self):
+        # (segment id, size in bytes, sealed) of all segments of the table
+        segment_ids = self.segment_ids()
+        return [(segment_id, os.path.getsize(self.segment_path(segment_id)),
+                 segment_id != segment_ids[-1] or self.is_marked_sealed(segment_id))
+                for segment_id in segment_ids]
+
+    def remap(self, segment_id):
+        # segments are append only: a read past the end of the mapping means
+        # that the segment grew since it was mapped. Views into the old
+        # mapping keep it alive, so it is dropped instead of closed.
+        fhandle = self.get_fhandle(segment_id)
+        with self.handle_lock:
+            if os.fstat(fhandle.fileno()).st_size == 0: mapped = b''
+            else: mapped = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmaps[segment_id] = mapped
+        return mapped
+
+    def close_segments(self, segment_ids=None):
+        if segment_ids is None: segment_ids = list(self.fhandles.keys())
+        for segment_id in segment_ids:
+            self.mmaps.pop(segment_id, None)
+            fhandle = self.fhandles.pop(segment_id, None)
+            if fhandle is not None: fhandle.close()
 
     def close_connection(self):
         #os.remove(join(self.base_dir, self.name + '_lock'))
         print('connecting is being closed...')
         assert self.read_fhandle is not None, 'Connection to table is not open!'
-        self.read_fhandle.close()
+        self.writer.close()
+        self.close_segments()
 
     def __exit__(self):
         self.close_connection()
 
     def add_pointer(self, key, pointer):
         if key == pointer: return
-        start, length, strType, strPointers, strArgs = self.db.get(join(self.name, key)).split(' ')
-        pointers = ujson.loads(strPointers)
+        start, length, type_value, pointers, vargs, codec = self.get(key)
         pointers.append(pointer)
-        strPointers = ujson.dumps(pointers)
-        self.db.set(join(self.name, key), ' '.join([start, length, strType, strPointers, strArgs]))
+        self.store.set(join(self.name, key), self.encode_metadata(start, length, type_value, vargs, pointers, codec))
+        self.invalidate(key)
+
+    def invalidate(self, key):
+        if self.cache is not None: self.cache.invalidate(key)
+
 
+    def set(self, key, start, length, type_value, vargs=[], codec=0):
+        self.store.set(join(self.name, key), self.encode_metadata(start, length, type_value, vargs, codec=codec))
+        self.invalidate(key)
 
-    def set(self, key, start, length, type_value, vargs=[]):
-        strArgs = ujson.dumps(vargs)
-        strType = types.get_type_str(type_value)
-        self.db.set(join(self.name, key), ' '.join([str(start), str(length), strType, '[]', strArgs]))
+    def delete(self, key):
+        # removes the metadata of the key and its pointers; the bytes stay in
+        # the table file
+        values = self.get(key)
+        if values is None: return False
+        keys = [key] + values[3]
+        self.store.delete(*[join(self.name, k) for k in keys])
+        for k in keys:
+            self.invalidate(k)
+        self.unregister(key)
+        return True
 
+    def encode_metadata(self, start, length, type_value, vargs, pointers=[], codec=0):
+        flags = 0
+        sections = []
+        type_code = int(types.get_type_str(type_value))
+        if codec != 0:
+            flags |= FLAG_CODEC
+            sections.append(metadata_codec.pack(codec))
+        if len(pointers) > 0:
+            flags |= FLAG_POINTERS
+            strPointers = ujson.dumps(pointers).encode()
+            sections.append(metadata_section.pack(len(strPointers)))
+            sections.append(strPointers)
+        if len(vargs) > 0:
+            # packed by the type the record decodes to
+            packed = self.pack_vargs(types.get_type(str(type_code)), vargs)
+            if packed is not None:
+                flags |= FLAG_PACKED_VARGS
+                sections.append(packed)
+            else:
+                flags |= FLAG_VARGS
+                sections.append(ujson.dumps(vargs).encode())
+        header = metadata_header.pack(METADATA_VERSION, type_code, flags, int(start), int(length))
+        return header + b''.join(sections)
+
+    def set_many(self, items):
+        # items are (key, start, length, type_value[, vargs[, codec]]) tuples
+        # which are published with one pipelined round trip, in a transaction
+        # with the registry entries of the keys which wait for it
+        pipe = self.store.pipeline(transaction=True)
+        for item in items:
+            key, start, length, type_value = item[:4]
+            vargs = item[4] if len(item) > 4 else []
+            codec = item[5] if len(item) > 5 else 0
+            pipe.set(join(self.name, key), self.encode_metadata(start, length, type_value, vargs, codec=codec))
+            self.invalidate(key)
+        keys = [item[0] for item in items if item[0] in self.unregistered]
+        self.queue_register(pipe, keys)
+        pipe.execute()
+        self.unregistered.difference_update(keys)
+
+    @timed('phase.metadata')
     def get(self, key):
-        value = self.db.get(join(self.name, key))
+        if self.metrics is not None: self.metrics.count('metadata.keys')
+        return self.decode_metadata(self.store.get(join(self.name, key)))
+
+    @timed('phase.metadata')
+    def get_many(self, keys):
+        # one MGET round trip for the whole batch instead of one GET per key
+        if len(keys) == 0: return []
+        if self.metrics is not None: self.metrics.count('metadata.keys', len(keys))
+        values = self.store.mget([join(self.name, key) for key in keys])
+        return [self.decode_metadata(value) for value in values]
+
+    def decode_metadata(self, value):
         if value is None: return
+        elif value[:1] != b'\x01':
+            return self.decode_legacy_metadata(value)
         else:
-            start, length, strType, strPointers , strArgs = value.split(' ')
-            start, length = int(start), int(length)
-            type_value = types.get_type(strType)
-            vargs = ujson.loads(strArgs)
-            pointers = ujson.loads(strPointers)
-            return start, length, type_value, pointers, vargs
+            version, type_code, flags, start, length = metadata_header.unpack_from(value)
+            type_value = types.get_type(str(type_code))
+            offset = metadata_header.size
+            pointers = []
+            vargs = []
+            codec = 0
+            if flags & FLAG_CODEC:
+                codec, = metadata_codec.unpack_from(value, offset)
+                offset += metadata_codec.size
+            if flags & FLAG_POINTERS:
+                size, = metadata_section.unpack_from(value, offset)
+                offset += metadata_section.size
+                pointers = ujson.loads(value[offset:offset + size])
+                offset += size
+            if flags & FLAG_PACKED_VARGS:
+                vargs = self.unpack_vargs(type_value, value, offset)
+            elif flags & FLAG_VARGS:
+                vargs = ujson.loads(value[offset:])
+            return start, length, type_value, pointers, vargs, codec
+
+    def pack_vargs(self, type_value, vargs):
+        # None if the vargs have no packed form and are stored as JSON
+        if type_value is np.ndarray and len(vargs) == 3 and isinstance(vargs[0], str) and vargs[2] in ('C', 'F'):
+            dtype = vargs[0].encode()
+            shape = [int(dim) for dim in vargs[1]]
+            return (metadata_section.pack(len(dtype)) + dtype + metadata_ndim.pack(len(shape)) +
+                    struct.pack('<{0}Q'.format(len(shape)), *shape) + vargs[2].encode())
+        if type_value is list and len(vargs) == 2 and isinstance(vargs[0], str) and len(vargs[0]) == 1:
+            return metadata_list.pack(vargs[0].encode(), int(vargs[1]))
+        return None
+
+    def unpack_vargs(self, type_value, value, offset):
+        if type_value is np.ndarray:
+            size, = metadata_section.unpack_from(value, offset)
+            offset += metadata_section.size
+            dtype = bytes(value[offset:offset + size]).decode()
+            offset += size
+            ndim, = metadata_ndim.unpack_from(value, offset)
+            offset += metadata_ndim.size
+            shape = list(struct.unpack_from('<{0}Q'.format(ndim), value, offset))
+            offset += 8*ndim
+            return [dtype, shape, bytes(value[offset:offset + 1]).decode()]
+        strType, count = metadata_list.unpack_from(value, offset)
+        return [strType.decode(), count]
+
+    def decode_legacy_metadata(self, value):
+        # space separated text records written before the binary format
+        start, length, strType, strPointers , strArgs = value.decode('utf8').split(' ')
+        start, length = int(start), int(length)
+        type_value = types.get_type(strType)
+        vargs = ujson.loads(strArgs)
+        pointers = ujson.loads(strPointers)
+        return start, length, type_value, pointers, vargs, 0
+
+    def migrate_metadata(self, batch_size=1000):
+        # rewrites legacy text records in the binary format; returns the
+        # number of migrated keys
+        migrated = 0
+        keys = []
+        for key in self.store.scan_iter('{0}/*'.format(self.name), count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                migrated += self.migrate_metadata_batch(keys)
+                keys = []
+        migrated += self.migrate_metadata_batch(keys)
+        return migrated
+
+    def migrate_metadata_batch(self, keys):
+        if len(keys) == 0: return 0
+        pipe = self.store.pipeline()
+        migrated = 0
+        for key, value in zip(keys, self.store.mget(keys)):
+            # sets and binary records are skipped
+            if value is None or value[:1] == b'\x01': continue
+            start, length, type_value, pointers, vargs, codec = self.decode_legacy_metadata(value)
+            pipe.set(key, self.encode_metadata(start, length, type_value, vargs, pointers, codec))
+            migrated += 1
+        pipe.execute()
+        return migrated
+
+    def live_extents(self, batch_size=1000):
+        # yields (key, start, length) of every value that metadata points to
+        prefix = '{0}/'.format(self.name)
+        keys = []
+        for key in self.store.scan_iter('{0}*'.format(prefix), count=batch_size):
+            keys.append(key)
+            if len(keys) >= batch_size:
+                for extent in self.live_extents_batch(keys, prefix): yield extent
+                keys = []
+        for extent in self.live_extents_batch(keys, prefix): yield extent
+
+    def live_extents_batch(self, keys, prefix):
+        if len(keys) == 0: return []
+        extents = []
+        for key, value in zip(keys, self.store.mget(keys)):
+            # sets are skipped
+            if value is None: continue
+            start, length = self.decode_metadata(value)[:2]
+            extents.append((key[len(prefix):], start, length))
+        return extents
+
+    def compact(self, segment_ids=None, group_by=None, batch_size=1000):
+        # rewrites the live values of the given segments (all if None) into
+        # new segments in offset order, or grouped by 'key', 'column' or a
+        # function of the key, and removes the old segments. The segments are
+        # sealed first, which only takes the locks of writers briefly; readers
+        # and writers keep working during the copy since the swap of offsets
+        # skips keys which were written since. Processes which use the
+        # interval fsync policy need to flush before.
+        # Returns the number of reclaimed bytes.
+        self.flush()
+        if group_by == 'key': group_by = lambda key: key.split('/')[0]
+        elif group_by == 'column': group_by = lambda key: key[key.index('/')+1:] if '/' in key else ''
+        old_ids = self.seal_segments(segment_ids)
+        if len(old_ids) == 0: return 0
+        old_size = sum([os.path.getsize(self.segment_path(segment_id)) for segment_id in old_ids
+                        if os.path.exists(self.segment_path(segment_id))])
+        extents = [extent for extent in self.live_extents(batch_size) if unpack_offset(extent[1])[0] in old_ids]
+        if group_by is None: extents.sort(key=lambda extent: extent[1])
+        else: extents.sort(key=lambda extent: (group_by(extent[0]), extent[1]))
+
+        # segment ids are never reused since readers cache their handles
+        new_ids = []
+        new_size = 0
+        moved = {}
+        g = None
+        for key, start, length in extents:
+            if g is None or (g.tell() > 0 and g.tell() + length > self.segment_size):
+                if g is not None: new_size += self.finish_segment(g)
+                new_ids.append(self.claim_sealed_segment())
+                g = open(self.segment_path(new_ids[-1]), 'wb')
+            moved[key] = (start, length, pack_offset(new_ids[-1], g.tell()))
+            g.write(self.read(start, length))
+        if g is not None: new_size += self.finish_segment(g)
+
+        self.swap_offsets(moved, batch_size)
+        self.close_segments(old_ids)
+        for segment_id in old_ids:
+            for path in [self.segment_path(segment_id), self.seal_path(segment_id), self.segment_path(segment_id) + '.wlock']:
+                if os.path.exists(path): os.remove(path)
+        if self.cache is not None: self.cache.clear()
+        return old_size - new_size
+
+    def seal_segments(self, segment_ids=None):
+        # seals the given segments (all if None) and returns their ids. A
+        # writer which holds the lock finishes and publishes its write first;
+        # afterwards writers move on to other segments.
+        with self.writer.lock:
+            all_ids = self.segment_ids()
+            old_ids = all_ids if segment_ids is None else sorted(set(segment_ids) & set(all_ids))
+            for segment_id in old_ids:
+                # concurrent writers only hold the lock of their own segment
+                with self.writer.segment_lock(segment_id):
+                    self.seal(segment_id)
+        return old_ids
+
+    def claim_sealed_segment(self):
+        # writers pick segments under the lock, so they never append to a
+        # segment which a compaction writes
+        with self.writer.lock:
+            segment_id = self.claim_segment()
+            self.seal(segment_id)
+        return segment_id
+
+    def finish_segment(self, g):
+        g.flush()
+        os.fsync(g.fileno())
+        size = g.tell()
+        g.close()
+        return size
+
+    def swap_offsets(self, moved, batch_size=1000):
+        # moved maps keys to (old start, length, new start). Every batch is
+        # swapped in a transaction; keys which were deleted or rewritten since
+        # the scan are left as they are, pointers added since are kept.
+        keys = list(moved.keys())
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            self.store.update([join(self.name, key) for key in batch], lambda values: self.swap_batch(batch, values, moved))
+
+    def swap_batch(self, batch, values, moved):
+        items = []
+        for key, value in zip(batch, values):
+            if value is None: continue
+            start, length, type_value, pointers, vargs, codec = self.decode_metadata(value)
+            old_start, old_length, new_start = moved[key]
+            if start != old_start or length != old_length: continue
+            items.append((join(self.name, key), self.encode_metadata(new_start, length, type_value, vargs, pointers, codec)))
+        return items
 
     def sadd(self, key, value):
-        self.db.sadd('{0}/{1}'.format(self.name, key), value)
+        self.store.sadd('{0}/{1}'.format(self.name, key), value)
 
     def get_members(self, key):
-        return self.db.smembers('{0}/{1}'.format(self.name, key))
+        return self.store.smembers('{0}/{1}'.format(self.name, key))
+
+    def add_reference(self, key, reference_id):
+        # reference groups are Redis lists, so an append is a single RPUSH
+        pipe = self.store.pipeline()
+        pipe.rpush('{0}:references:{1}'.format(self.name, reference_id), key)
+        pipe.hset('{0}:reference'.format(self.name), key, reference_id)
+        pipe.execute()
+
+    def get_references(self, reference_id):
+        return self.store.lrange('{0}:references:{1}'.format(self.name, reference_id), 0, -1)
+
+    def get_reference(self, key):
+        return self.store.hget('{0}:reference'.format(self.name), key)
 
     def get_pointer(self, key):
-        value = self.db.get(join(self.name, key))
-        if value is None: return key
+        if not self.store.exists(join(self.name, key)): return key
         else: return join(key, str(uuid4()))
 
+    def index_key(self, col=None):
+        # the key registry lives next to the metadata: '<name>:keys' holds all
+        # keys, '<name>:rows' the keys without a column, '<name>:column:<col>'
+        # the keys with that column and '<name>:columns' the column names.
+        # Sorted sets use equal scores so that they can be ranged by prefix.
+        if col is None: return '{0}:rows'.format(self.name)
+        return '{0}:column:{1}'.format(self.name, col)
+
+    def split_key(self, key):
+        if '/' not in key: return key, None
+        return key[:key.index('/')], key[key.index('/')+1:]
+
+    def register(self, keys):
+        if len(keys) == 0: return
+        pipe = self.store.pipeline()
+        self.queue_register(pipe, keys)
+        pipe.execute()
+
+    def queue_register(self, pipe, keys):
+        # registering only adds to sets, so it can be queued with the
+        # metadata of the keys without reading the registry first
+        columns = set()
+        for key in keys:
+            key, col = self.split_key(key)
+            pipe.zadd(self.index_key(col), {key: 0})
+            pipe.zadd('{0}:keys'.format(self.name), {key: 0})
+            if col is not None: columns.add(col)
+        if len(columns) > 0: pipe.sadd('{0}:columns'.format(self.name), *sorted(columns))
+
+    def unregister(self, key):
+        key, col = self.split_key(key)
+        if self.store.zrem(self.index_key(col), key) == 0: return
+        # a key leaves the registry with its last entry, which is looked up
+        # in the indices of the columns
+        cols = [None] + self.columns()
+        pipe = self.store.pipeline()
+        for c in cols:
+            pipe.zscore(self.index_key(c), key)
+        pipe.zcard(self.index_key(col))
+        values = pipe.execute()
+        pipe = self.store.pipeline()
+        if all([score is None for score in values[:-1]]):
+            pipe.zrem('{0}:keys'.format(self.name), key)
+        if col is not None and values[-1] == 0:
+            pipe.srem('{0}:columns'.format(self.name), col)
+        pipe.execute()
+
+    def keys(self, prefix=None, col=None, batch_size=1000):
+        # keys in lexicographic order, optionally only those starting with
+        # prefix or those which have the column col
+        index_key = '{0}:keys'.format(self.name) if col is None else self.index_key(col)
+        prefix = (prefix or '').encode('utf8')
+        lower = b'[' + prefix
+        upper = b'[' + prefix + b'\xff' if len(prefix) > 0 else b'+'
+        while True:
+            keys = self.store.zrangebylex(index_key, lower, upper, start=0, num=batch_size)
+            for key in keys:
+                yield key
+            if len(keys) < batch_size: return
+            lower = b'(' + keys[-1].encode('utf8')
+
+    def columns(self):
+        return sorted(self.store.smembers('{0}:columns'.format(self.name)))
+
+    def count(self, col=None):
+        if col is None: return self.store.zcard('{0}:keys'.format(self.name))
+        return self.store.zcard(self.index_key(col))
+
     def key_col_iter(self):
-        for key in self.db.scan_iter(match='{0}/*'.format(self.name)):
-            key = key[len('{0}/'.format(self.name)):]
-            if key.count('/') > 0:
-                col = key[key.index('/')+1:]
-                key = key[:key.index('/')]
-            yield key, col
+        for key, score in self.store.zscan_iter(self.index_key()):
+            yield key, None
+        for col in self.columns():
+            for key, score in self.store.zscan_iter(self.index_key(col)):
+                yield key, col
+
+    def rebuild_index(self, batch_size=1000):
+        # registers the keys of tables written before the registry existed;
+        # list chunks are not keys of their own and are skipped
+        pipe = self.store.pipeline()
+        for col in self.columns():
+            pipe.delete(self.index_key(col))
+        for name in ['keys', 'rows', 'columns']:
+            pipe.delete('{0}:{1}'.format(self.name, name))
+        pipe.execute()
+        keys = []
+        for key in self.store.scan_iter('{0}/*'.format(self.name), count=batch_size):
+            keys.append(key[len(self.name) + 1:])
+            if len(keys) >= batch_size:
+                self.register(self.filter_chunks(keys))
+                keys = []
+        self.register(self.filter_chunks(keys))
+
+    def filter_chunks(self, keys):
+        metadata = self.get_many(keys)
+        keys = [key for key, values in zip(keys, metadata) if values is not None]
+        roots = [self.split_key(key)[0] for key in keys]
+        chunks = set()
+        for values in self.get_many(roots):
+            if values is not None: chunks.update(values[3])
+        return [key for key in keys if key not in chunks]
+
+
+handler_classes = [StringDataHandler, BytesDataHandler, IntDataHandler, ListDataHandler, DictDataHandler, NumpyDataHandler]
+
+def make_processors(tbl, fhandle=None, write_path=None):
+    processors = [handler(tbl, fhandle, write_path) for handler in handler_classes]
+    type2processor = {}
+    for p in processors:
+        for t in p.get_supported_types():
+            type2processor[t] = p
+    return processors, type2processor
+
+def serialize_records(type2processor, items, compression=None):
+    # serializes and compresses (key, value) pairs into write records
+    records = []
+    for key, value in items:
+        p = type2processor[type(value)]
+        value, type_value, args = p.serialize(value)
+        value, codec = p.compress(value, args, compression)
+        records.append((key, value, type_value, args, codec))
+    return records
+
+
+class BatchWriter(object):
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.items = []
+
+    def set(self, key, value, col=None):
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        self.items.append((key, value))
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        items, self.items = self.items, []
+        self.db.set_many(items)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
 
 
 class Redisk(object):
-    def __init__(self, tbl):
+    def __init__(self, tbl, max_read_gap=4096, cache_bytes=0, cache_admission=None):
         self.tbl = tbl
         self.processors = []
         self.type2processor = {}
         self.base_processor = None
+        self.max_read_gap = max_read_gap
+        self.cache = None
+        # thread pool of parallel_batched_get, created on first use
+        self.executor = None
+        self.executor_threads = None
+        self.cache_bytes = cache_bytes
+        self.cache_admission = cache_admission
+        if cache_bytes > 0:
+            # by default large arrays do not push everything else out of the cache
+            if cache_admission is None: cache_admission = {np.ndarray: 1 << 20}
+            self.cache = LRUCache(cache_bytes, cache_admission)
+            self.tbl.cache = self.cache
 
         self.construct_processors()
+        open_dbs.add(self)
+
+    def __reduce__(self):
+        return Redisk, (self.tbl, self.max_read_gap, self.cache_bytes, self.cache_admission)
+
+    def after_fork(self):
+        # threads do not survive a fork and appends buffered by the parent
+        # are flushed by the parent
+        self.executor = None
+        for p in self.processors:
+            p.after_fork()
 
     def construct_processors(self):
         fhandle, wpath = self.tbl.open_connection()
-        self.processors.append(StringDataHandler(self.tbl, fhandle, wpath))
-        self.processors.append(IntDataHandler(self.tbl, fhandle, wpath))
-        self.processors.append(ListDataHandler(self.tbl, fhandle, wpath))
-        self.processors.append(DictDataHandler(self.tbl, fhandle, wpath))
-        self.processors.append(NumpyDataHandler(self.tbl, fhandle, wpath))
+        self.base_processor = AbstractDataHandler(self.tbl, fhandle, wpath)
+        self.processors, self.type2processor = make_processors(self.tbl, fhandle, wpath)
         for p in self.processors:
-            for t in p.get_supported_types():
-                self.type2processor[t] = p
+            p.max_read_gap = self.max_read_gap
 
-    def set(self, key, value, col=None, reference_id=None):
+    @timed('op.set')
+    def set(self, key, value, col=None, reference_id=None, compression=None):
         if col is not None: key = '{0}/{1}'.format(key, col)
-        self.type2processor[type(value)].set(key, value)
+        self.tbl.invalidate(key)
+        self.tbl.unregistered.add(key)
+        self.type2processor[type(value)].set(key, value, compression)
         if reference_id is not None:
-            references_key = join('references', str(reference_id))
-            if self.exists(references_key): references = self.get(references_key)
-            else: references = []
-            references.append(key)
-            self.set(join('references', str(reference_id)), references)
-            self.set(join(key, 'reference'), str(reference_id))
+            self.tbl.add_reference(key, str(reference_id))
+
+    @timed('op.set_many')
+    def set_many(self, items, compression=None):
+        # items is a dict or an iterable of (key, value) pairs
+        if isinstance(items, dict): items = items.items()
+        self.set_records(serialize_records(self.type2processor, items, compression))
+
+    def set_records(self, records):
+        # records are serialized (key, value, type_value, args, codec) tuples
+        for record in records:
+            self.tbl.invalidate(record[0])
+            self.tbl.unregistered.add(record[0])
+        self.base_processor.set_bytes_many(records)
+
+    def writer(self, batch_size=10000):
+        return BatchWriter(self, batch_size)
 
     def exists(self, key):
-        return self.tbl.get(key) is not None
+        return self.get_metadata(key) is not None
+
+    @timed('op.delete')
+    def delete(self, key, col=None):
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        return self.tbl.delete(key)
+
+    @timed('op.get')
+    @retry_removed
+    def get(self, key, col=None, index=None):
+        if index is not None: return self.get_array_slice(key, index, col)
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        if self.cache is not None:
+            data = self.cache.get('value', key)
+            if data is not None: return data
+        values = self.get_metadata(key)
+        data = self.get_with_metadata(key, values)
+        self.cache_value(key, values, data)
+        return data
+
+    @timed('op.get_column')
+    @retry_removed
+    def get_column(self, keys, col):
+        # reads one column of many keys; ints and arrays of the same dtype and
+        # shape are stacked into one array, other columns are returned as a
+        # list (with None for missing keys)
+        column_keys = ['{0}/{1}'.format(key, col) for key in keys]
+        metadata = self.get_metadata_many(column_keys)
+        type_values = set(values[2] if values is not None else None for values in metadata)
+        if len(type_values) == 1 and all(len(values[3]) == 0 for values in metadata if values is not None):
+            p = self.type2processor.get(type_values.pop())
+            if p is not None:
+                triples = [(key, values[0], values[1]) for key, values in zip(column_keys, metadata)]
+                data = p.batched_stack(triples, [values[4] for values in metadata], [values[5] for values in metadata])
+                if data is not None: return data
+        return self.batched_get(column_keys)
 
-    def get(self, key, col=None):
+    @timed('op.get_array_slice')
+    @retry_removed
+    def get_array_slice(self, key, rows, col=None):
+        # reads only the requested rows of an array instead of the whole array
         if col is not None: key = '{0}/{1}'.format(key, col)
-        values = self.tbl.get(key)
+        values = self.get_metadata(key)
+        if values is None: return None
+        start, length, type_value, pointers, vargs, codec = values
+        if type_value is not np.ndarray:
+            raise Exception('Rows can only be read from arrays, but {0} is of type {1}!'.format(key, type_value))
+        return self.type2processor[np.ndarray].get_rows(key, int(start), int(length), vargs, codec, rows)
+
+    def get_metadata(self, key):
+        if self.cache is None: return self.tbl.get(key)
+        return self.get_metadata_many([key])[0]
+
+    def get_metadata_many(self, keys):
+        if self.cache is None: return self.tbl.get_many(keys)
+        metadata = [self.cache.get('metadata', key) for key in keys]
+        missing = [i for i, values in enumerate(metadata) if values is None]
+        for i, values in zip(missing, self.tbl.get_many([keys[i] for i in missing])):
+            metadata[i] = values
+            if values is not None: self.cache.put('metadata', keys[i], values, metadata_size + value_size(values[3]))
+        return metadata
+
+    def cache_value(self, key, values, data):
+        # values with pointers grow through append and are not cached
+        if self.cache is None or data is None or len(values[3]) > 0: return
+        # entries are sized by the decoded value, not by its encoding
+        self.cache.put('value', key, data, value_size(data), values[2])
+
+    @property
+    def metrics(self):
+        return self.tbl.metrics
+
+    def metrics_snapshot(self):
+        if self.tbl.metrics is None: return None
+        return self.tbl.metrics.snapshot()
+
+    def cache_stats(self):
+        if self.cache is None: return None
+        return self.cache.stats()
+
+    def get_with_metadata(self, key, values):
         if values is None: return None
-        start, length, type_value, pointers, vargs = values
-        data = self.type2processor[type_value].get(key, start, length, vargs)
+        start, length, type_value, pointers, vargs, codec = values
+        data = self.type2processor[type_value].get(key, start, length, vargs, codec)
         if len(pointers) > 0:
-            for p in pointers:
-                data += self.get(p)
+            # all chunks are fetched with one metadata lookup and a coalesced read
+            for chunk in self.batched_get(pointers):
+                if chunk is not None: data += chunk
         return data
 
     def sadd(self, key, value):
@@ -150,37 +905,195 @@ class Redisk(object):
         for key, col in self.tbl.key_col_iter():
             yield key, col
 
+    def keys(self, prefix=None):
+        return self.tbl.keys(prefix)
+
+    def keys_with_column(self, col, prefix=None):
+        return self.tbl.keys(prefix, col)
+
+    def columns(self):
+        return self.tbl.columns()
+
+    def count(self, col=None):
+        return self.tbl.count(col)
+
+    def rebuild_index(self, batch_size=1000):
+        self.flush()
+        self.tbl.rebuild_index(batch_size)
+
+    @timed('op.batched_get')
+    @retry_removed
     def batched_get(self, keys):
-        triples = []
-        type_value_batch = None
-        for key in keys:
-            start, length, type_value, pointers, vargs = self.tbl.get(key)
-            if type_value_batch is None: type_value_batch = type_value
-            assert type_value == type_value_batch, 'Batched queries only work for a single data type!'
+        if self.cache is None: return self.fetch_many(keys)
+        data = [self.cache.get('value', key) for key in keys]
+        missing = [i for i, value in enumerate(data) if value is None]
+        for i, value in zip(missing, self.fetch_many([keys[i] for i in missing])):
+            data[i] = value
+        return data
+
+    @timed('op.parallel_batched_get')
+    @retry_removed
+    def parallel_batched_get(self, keys, threads=8, min_batch_size=256):
+        # fans a large batch out over a pool of threads. The metadata is
+        # fetched once and the keys are split into runs of neighbouring
+        # offsets so that every thread still reads with few coalesced reads.
+        data = [None]*len(keys)
+        missing = list(range(len(keys)))
+        if self.cache is not None:
+            data = [self.cache.get('value', key) for key in keys]
+            missing = [i for i, value in enumerate(data) if value is None]
+        metadata = self.get_metadata_many([keys[i] for i in missing])
+        order = sorted(range(len(missing)), key=lambda j: metadata[j][0] if metadata[j] is not None else -1)
+        size = max(min_batch_size, -(-len(order)//threads))
+        runs = [order[i:i + size] for i in range(0, len(order), size)]
+        if len(runs) > 1:
+            if self.executor is None or self.executor_threads != threads:
+                if self.executor is not None: self.executor.shutdown()
+                self.executor, self.executor_threads = ThreadPoolExecutor(threads), threads
+            results = self.executor.map(lambda run: self.fetch_many([keys[missing[j]] for j in run], metadata=[metadata[j] for j in run]), runs)
+        else:
+            results = [self.fetch_many([keys[missing[j]] for j in run], metadata=[metadata[j] for j in run]) for run in runs]
+        for run, values in zip(runs, results):
+            for j, value in zip(run, values):
+                data[missing[j]] = value
+        return data
+
+    @retry_removed
+    def fetch_many(self, keys, follow_pointers=True, metadata=None):
+        # keys are grouped by handler so that every group is read and decoded
+        # in bulk; missing keys yield None
+        data = [None]*len(keys)
+        if metadata is None: metadata = self.get_metadata_many(keys)
+        groups = OrderedDict()
+        pointer_keys = []
+        for i, (key, values) in enumerate(zip(keys, metadata)):
+            if values is None: continue
+            start, length, type_value, pointers, vargs, codec = values
+            indices, triples, batch_vargs, codecs = groups.setdefault(self.type2processor[type_value], ([], [], [], []))
+            indices.append(i)
             triples.append((key, int(start), int(length)))
-        return self.type2processor[type_value].batched_get(triples, None)
+            batch_vargs.append(vargs)
+            codecs.append(codec)
+            if not follow_pointers: continue
+            for p in pointers:
+                pointer_keys.append((i, p))
 
-    def get_with_reference(self, reference_id):
-        references = self.get(join('references', str(reference_id)))
-        data = []
-        for key in references:
-            data.append(self.get(key))
+        for p, (indices, triples, batch_vargs, codecs) in groups.items():
+            for i, value in zip(indices, p.batched_get(triples, batch_vargs, codecs)):
+                data[i] = value
+
+        if len(pointer_keys) > 0:
+            chunks = self.batched_get([p for i, p in pointer_keys])
+            for (i, p), chunk in zip(pointer_keys, chunks):
+                if chunk is not None: data[i] += chunk
+
+        for key, values, value in zip(keys, metadata, data):
+            self.cache_value(key, values, value)
         return data
 
+    def compact(self, segment_ids=None, group_by=None, batch_size=1000):
+        self.flush()
+        return self.tbl.compact(segment_ids, group_by, batch_size)
+
+    @timed('op.get_with_reference')
+    def get_with_reference(self, reference_id):
+        # groups written by older versions are list values of their own
+        references = self.get(join('references', str(reference_id))) or []
+        references += self.tbl.get_references(str(reference_id))
+        return self.batched_get(references)
+
     def get_reference(self, key):
-        return self.get(join(key, 'reference'))
+        reference_id = self.tbl.get_reference(key)
+        if reference_id is None: return self.get(join(key, 'reference'))
+        return reference_id
 
-    def append(self, key, value, flush_length_threshold=10000000):
-        self.type2processor[list].append(key, value, flush_length_threshold)
+    @timed('op.append')
+    def append(self, key, value, flush_length_threshold=10000000, flush_bytes_threshold=None):
+        self.tbl.invalidate(key)
+        # a key is registered once per chunk, not once per element
+        if key not in self.type2processor[list].temp_store: self.tbl.register([key])
+        self.type2processor[list].append(key, value, flush_length_threshold, flush_bytes_threshold)
 
-    def close(self):
+    def iter_list(self, key, col=None, prefetch=16):
+        # yields the elements of a list chunk by chunk, reading prefetch
+        # chunks at a time, instead of materializing the whole list
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        values = self.get_metadata(key)
+        if values is None: return
+        chunk_keys = [key] + values[3]
+        for i in range(0, len(chunk_keys), prefetch):
+            for chunk in self.fetch_many(chunk_keys[i:i + prefetch], follow_pointers=False):
+                if chunk is None: continue
+                for value in chunk:
+                    yield value
+
+    @timed('op.get_slice')
+    @retry_removed
+    def get_slice(self, key, start, stop, col=None):
+        # reads only the chunks which overlap [start, stop); of uncompressed
+        # typed chunks only the bytes of the requested elements are read
+        if col is not None: key = '{0}/{1}'.format(key, col)
+        values = self.get_metadata(key)
+        if values is None: return None
+        p = self.type2processor[list]
+        chunk_keys = [key] + values[3]
+        metadata = [values] + self.get_metadata_many(values[3])
+        loaded = {}
+        counts = [0 if m is None else p.count(int(m[1]), m[4], m[5]) for m in metadata]
+        unknown = [i for i, count in enumerate(counts) if count is None]
+        if len(unknown) > 0:
+            # chunks without an element count need to be read to be counted
+            for i, chunk in zip(unknown, self.fetch_many([chunk_keys[i] for i in unknown], follow_pointers=False)):
+                loaded[i] = chunk
+                counts[i] = len(chunk)
+        start, stop, _ = slice(start, stop).indices(sum(counts))
+
+        triples, batch_vargs, codecs, parts = [], [], [], []
+        offset = 0
+        for i, (m, count) in enumerate(zip(metadata, counts)):
+            lower, upper = max(start - offset, 0), min(stop - offset, count)
+            offset += count
+            if lower >= upper: continue
+            if i in loaded:
+                parts.append((None, loaded[i][lower:upper]))
+                continue
+            chunk_start, length, type_value, pointers, vargs, codec = m
+            if p.is_sliceable(vargs, codec):
+                itemsize = p.itemsize(vargs)
+                triples.append((chunk_keys[i], int(chunk_start) + lower*itemsize, (upper - lower)*itemsize))
+                parts.append((len(triples) - 1, None))
+            else:
+                triples.append((chunk_keys[i], int(chunk_start), int(length)))
+                parts.append((len(triples) - 1, (lower, upper)))
+            batch_vargs.append(vargs)
+            codecs.append(codec)
+
+        chunks = p.batched_get(triples, batch_vargs, codecs) if len(triples) > 0 else []
+        data = []
+        for index, part in parts:
+            if index is None: data.extend(part)
+            elif part is None: data.extend(chunks[index])
+            else: data.extend(chunks[index][part[0]:part[1]])
+        return data
+
+    def flush(self):
         for p in self.processors:
             p.close()
+        self.tbl.flush()
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def delete_db(self):
+        self.tbl.writer.close()
+        if self.cache is not None: self.cache.clear()
+        self.tbl.store.flushdb()
         if os.path.exists(self.tbl.base_dir):
             shutil.rmtree(self.tbl.base_dir)
-        self.tbl.db.flushdb()
+        self.tbl.store.close()
 
     def __exit__(self):
         self.close()
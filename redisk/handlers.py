@@ -1,4 +1,6 @@
 import sys
+import ast
+import time
 import array
 import ujson
 import numpy as np
@@ -6,9 +8,8 @@ import numpy as np
 from os.path import join
 from collections import OrderedDict
 
-from filelock import Timeout, FileLock
-
-from redisk.util import Types
+from redisk.util import Types, plan_reads
+from redisk import compression
 
 types = Types()
 
@@ -18,72 +19,161 @@ class AbstractDataHandler(object):
         self.fhandle = fhandle
         self.supported_types = set()
         self.wpath = write_path
+        # ranges closer than this many bytes are merged into one read
+        self.max_read_gap = 4096
 
     def get_supported_types(self):
         return self.supported_types
 
-    def set_bytes(self, key, value, type_value, *args):
-        # process safe write
-        # high timeout of 10 seconds in the case somebody dumps a large numpy array
-        lock = FileLock(self.wpath + '.lock', timeout=10)
-        with lock:
-            with open(self.wpath, 'ab+') as g:
-                g.seek(0, 2)
-                start = g.tell()
-                g.write(value)
-                end = g.tell()
-                length = end-start
-        self.tbl.set(key, start, length, type_value, *args)
+    @property
+    def metrics(self):
+        return self.tbl.metrics if self.tbl is not None else None
+
+    def set_bytes(self, key, value, type_value, *args, codec=0):
+        self.tbl.append_bytes([(key, value, type_value, args, codec)])
+
+    def set_bytes_many(self, records):
+        # records are (key, value, type_value, args, codec) tuples
+        self.tbl.append_bytes(records)
 
     def get_bytes(self, key, start, length):
-        self.fhandle.seek(int(start))
-        value = self.fhandle.read(int(length))
+        # bytes, or a memoryview into the table file if the table uses mmap
+        value = self.tbl.read(start, length)
         if value is None: return None
         return value
 
+    def batched_get_bytes(self, triples):
+        # reads the triples in offset order with coalesced reads and returns
+        # the values in the order of the triples
+        ranges = [(int(start), int(length)) for key, start, length in triples]
+        values = [None]*len(ranges)
+        for start, end, indices in plan_reads(ranges, self.max_read_gap):
+            buffer = self.tbl.read(start, end - start)
+            for i in indices:
+                offset = ranges[i][0] - start
+                values[i] = buffer[offset:offset + ranges[i][1]]
+        return values
+
     def batched_get_string(self, triples):
-        ret_values = []
-        for key, start, length in triples:
-            self.fhandle.seek(start)
-            ret_values.append(self.fhandle.read(length).decode('utf8'))
-        return ret_values
+        return [str(value, 'utf8') for value in self.batched_get_bytes(triples)]
+
+    def batched_get(self, triples, vargs, codecs=None):
+        values = self.batched_get_bytes(triples)
+        metrics = self.metrics
+        if metrics is None:
+            if codecs is not None:
+                values = [self.decompress(value, args, codec) for value, args, codec in zip(values, vargs, codecs)]
+            return self.batched_decode(values, vargs)
+        start = time.perf_counter()
+        if codecs is not None:
+            values = [self.decompress(value, args, codec) for value, args, codec in zip(values, vargs, codecs)]
+        decoded = time.perf_counter()
+        data = self.batched_decode(values, vargs)
+        self.observe_decode(metrics, start, decoded, len(values))
+        return data
+
+    def observe_decode(self, metrics, start, decoded, count):
+        end = time.perf_counter()
+        metrics.observe('phase.decompress', decoded - start)
+        metrics.observe('phase.decode', end - decoded)
+        metrics.observe('decode.' + type(self).__name__, end - decoded)
+        metrics.count('values.' + type(self).__name__, count)
+
+    def batched_decode(self, values, vargs):
+        return [self.decode(value, args) for value, args in zip(values, vargs)]
+
+    def batched_stack(self, triples, vargs, codecs):
+        # values which can be stacked into one array; None if they cannot
+        return None
 
     def close(self):
         pass
 
-    def set(self, key, value):
-        raise NotImplementedError('Classes that inherit from AbstractDataHandler need to implement the set method!')
+    def after_fork(self):
+        pass
+
+    def set(self, key, value, codec=None):
+        value, type_value, args = self.serialize(value)
+        value, codec = self.compress(value, args, codec)
+        self.set_bytes(key, value, type_value, *args, codec=codec)
 
-    def get(self, key, start, length, vargs):
-        raise NotImplementedError('Classes that inherit from AbstractDataHandler need to implement the get method!')
+    def serialize(self, value):
+        raise NotImplementedError('Classes that inherit from AbstractDataHandler need to implement the serialize method!')
+
+    def compress(self, value, args, codec=None):
+        # codec is a codec name; the table wide compression is used if it is None
+        if codec is None: codec = self.tbl.compression
+        if codec is None or codec == 'none': return value, 0
+        itemsize = self.itemsize(args[0] if len(args) > 0 else [])
+        codec_id = compression.get_codec(codec, shuffle=itemsize > 1)
+        return compression.compress(value, codec_id, itemsize), codec_id
+
+    def decompress(self, value, vargs, codec):
+        if codec == 0: return value
+        return compression.decompress(value, codec, self.itemsize(vargs))
+
+    def itemsize(self, vargs):
+        # values with fixed size items are byte shuffled before compression
+        return 1
+
+    def get(self, key, start, length, vargs, codec=0):
+        value = self.get_bytes(key, start, length)
+        if value is None: return None
+        metrics = self.metrics
+        if metrics is None: return self.decode(self.decompress(value, vargs, codec), vargs)
+        start = time.perf_counter()
+        value = self.decompress(value, vargs, codec)
+        decoded = time.perf_counter()
+        data = self.decode(value, vargs)
+        self.observe_decode(metrics, start, decoded, 1)
+        return data
+
+    def decode(self, value, vargs):
+        raise NotImplementedError('Classes that inherit from AbstractDataHandler need to implement the decode method!')
 
 class StringDataHandler(AbstractDataHandler):
     def __init__(self, tbl, fhandle, write_path):
         super(StringDataHandler, self).__init__(tbl, fhandle, write_path)
         self.supported_types.add(str)
-        self.supported_types.add(bytes)
 
-    def set(self, key, value):
-        self.set_bytes(key, value.encode('utf8'), type(value))
+    def serialize(self, value):
+        return value.encode('utf8'), type(value), []
+
+    def decode(self, value, vargs):
+        return str(value, 'utf8')
 
-    def get(self, key, start, length, vargs):
-        return self.get_bytes(key, start, length).decode('utf8')
+    def batched_decode(self, values, vargs):
+        return [str(value, 'utf8') for value in values]
+
+class BytesDataHandler(AbstractDataHandler):
+    def __init__(self, tbl, fhandle, write_path):
+        super(BytesDataHandler, self).__init__(tbl, fhandle, write_path)
+        self.supported_types.add(bytes)
 
-    def batched_get(self, triples, vargs):
-        return self.batched_get_string(triples)
+    def serialize(self, value):
+        return value, type(value), []
+
+    def decode(self, value, vargs):
+        # zero-copy memoryview if the table is memory mapped
+        return value
 
 class IntDataHandler(AbstractDataHandler):
     def __init__(self, tbl, fhandle, write_path):
         super(IntDataHandler, self).__init__(tbl, fhandle, write_path)
         self.supported_types.add(int)
 
-    def set(self, key, value):
-        self.set_bytes(key, str(value).encode(), type(value))
+    def serialize(self, value):
+        return str(value).encode(), type(value), []
 
-    def get(self, key, start, length, vargs):
-        value = self.get_bytes(key, start, length)
-        if value is None: return None
-        return int(value.decode())
+    def decode(self, value, vargs):
+        return int(str(value, 'utf8'))
+
+    def batched_stack(self, triples, vargs, codecs):
+        values = self.batched_get(triples, vargs, codecs)
+        try:
+            return np.fromiter(values, dtype=np.int64, count=len(values))
+        except OverflowError:
+            return None
 
 class DictDataHandler(AbstractDataHandler):
     def __init__(self, tbl, fhandle, write_path):
@@ -91,13 +181,16 @@ class DictDataHandler(AbstractDataHandler):
         self.supported_types.add(dict)
         self.supported_types.add(OrderedDict)
 
-    def set(self, key, value):
-        self.set_bytes(key, ujson.dumps(value).encode(), type(value))
+    def serialize(self, value):
+        return ujson.dumps(value).encode(), type(value), []
 
-    def get(self, key, start, length, vargs):
-        value = self.get_bytes(key, start, length)
-        if value is None: return None
-        return ujson.loads(value.decode())
+    def decode(self, value, vargs):
+        return ujson.loads(str(value, 'utf8'))
+
+    def batched_decode(self, values, vargs):
+        if len(values) == 0: return []
+        # a single ujson pass for the whole batch
+        return ujson.loads(b'[' + b','.join(values) + b']')
 
 class ListDataHandler(AbstractDataHandler):
     def __init__(self, tbl, fhandle, write_path):
@@ -105,87 +198,257 @@ class ListDataHandler(AbstractDataHandler):
         self.supported_types.add(list)
         self.strType2ArrayType = {}
         self.strType2ArrayType['2'] = 'i'
+        # chunks written from the typed buffers of append
+        self.strType2ArrayType['q'] = 'q'
+        self.strType2ArrayType['d'] = 'd'
         self.temp_store = {}
         self.temp_store_lengths = {}
-
-    def set(self, key, value):
+        self.temp_store_bytes = {}
+
+    def serialize(self, value):
+        # vargs hold the element type and the number of elements so that
+        # slices can be planned from the metadata alone
+        if isinstance(value, array.array):
+            return value.tobytes(), list, [[value.typecode, len(value)]]
+        if isinstance(value[0], float):
+            return self.serialize(array.array('d', value))
         strType = types.get_type_str(type(value[0]))
         if strType in self.strType2ArrayType:
-            self.set_with_array(key, value, strType)
+            return self.set_with_array(None, value, strType)
         elif strType in ['0', '1']:
             str_value = ujson.dumps(value)
-            self.set_bytes(key, str_value.encode(), type(value), strType)
+            return str_value.encode(), type(value), [[strType, len(value)]]
         else:
             raise Exception('Type not supported!')
 
-
-    def get(self, key, start, length, vargs):
-        value = self.get_bytes(key, start, length)
-        if value is None: return None
+    def decode(self, value, vargs):
+        strType = str(vargs[0])
+        if strType in self.strType2ArrayType:
+            return self.get_with_array(None, value, strType)
+        elif strType in ['0', '1']:
+            return ujson.loads(str(value, 'utf8'))
         else:
-            strType = str(vargs[0])
+            raise Exception('Type not supported!')
+
+    def itemsize(self, vargs):
+        strType = str(vargs[0])
+        if strType in self.strType2ArrayType:
+            return array.array(self.strType2ArrayType[strType]).itemsize
+        return 1
+
+    def count(self, length, vargs, codec=0):
+        # number of elements of a chunk, or None if the chunk has to be read
+        if isinstance(vargs, list) and len(vargs) > 1: return vargs[1]
+        if str(vargs[0]) in self.strType2ArrayType and codec == 0:
+            return length // self.itemsize(vargs)
+        return None
+
+    def is_sliceable(self, vargs, codec=0):
+        # elements of uncompressed typed chunks can be read without the rest of the chunk
+        return str(vargs[0]) in self.strType2ArrayType and codec == 0
+
+    def batched_decode(self, values, vargs):
+        data = [None]*len(values)
+        groups = OrderedDict()
+        for i, args in enumerate(vargs):
+            groups.setdefault(str(args[0]), []).append(i)
+
+        for strType, indices in groups.items():
             if strType in self.strType2ArrayType:
-                arrayType = vargs[0]
-                return self.get_with_array(key, value, strType)
+                # decode all arrays of the same type at once and split them up again
+                arrayType = self.strType2ArrayType[strType]
+                joined = array.array(arrayType)
+                joined.frombytes(b''.join([values[i] for i in indices]))
+                joined = joined.tolist()
+                offset = 0
+                for i in indices:
+                    count = len(values[i]) // array.array(arrayType).itemsize
+                    data[i] = joined[offset:offset + count]
+                    offset += count
             elif strType in ['0', '1']:
-                return ujson.loads(value)
+                decoded = ujson.loads(b'[' + b','.join([values[i] for i in indices]) + b']')
+                for i, value in zip(indices, decoded):
+                    data[i] = value
             else:
                 raise Exception('Type not supported!')
+        return data
+
+    def new_buffer(self, value):
+        # numbers are buffered in typed arrays which are written out as they are
+        if isinstance(value, float): return array.array('d')
+        if isinstance(value, int) and not isinstance(value, bool): return array.array('q')
+        return []
 
-    def append(self, key, value, flush_length_threshold):
+    def append(self, key, value, flush_length_threshold, flush_bytes_threshold=None):
         if key not in self.temp_store:
-            self.temp_store[key] = []
+            self.temp_store[key] = self.new_buffer(value)
             self.temp_store_lengths[key] = 0
+            self.temp_store_bytes[key] = 0
 
-        self.temp_store[key].append(value)
+        buffer = self.temp_store[key]
+        buffer.append(value)
         self.temp_store_lengths[key] += 1
+        if isinstance(buffer, array.array): self.temp_store_bytes[key] += buffer.itemsize
+        else: self.temp_store_bytes[key] += len(value) if isinstance(value, (str, bytes)) else sys.getsizeof(value)
 
         if self.temp_store_lengths[key] >= flush_length_threshold:
             self.flush(key)
+        elif flush_bytes_threshold is not None and self.temp_store_bytes[key] >= flush_bytes_threshold:
+            self.flush(key)
 
     def flush(self, key):
         values = self.temp_store.pop(key)
         self.temp_store_lengths.pop(key)
+        self.temp_store_bytes.pop(key)
         pointer = self.tbl.get_pointer(key)
         self.set(pointer, values)
+        # pointers are resolved through the metadata, so it has to be published
+        self.tbl.flush()
         self.tbl.add_pointer(key, pointer)
 
     def set_with_array(self, key, value, strType):
         arrayType = self.strType2ArrayType[strType]
         str_value = array.array(arrayType, value).tobytes()
-        self.set_bytes(key, str_value, type(value), strType)
+        return str_value, type(value), [[strType, len(value)]]
 
     def get_with_array(self, key, value, strType):
         arrayType = self.strType2ArrayType[strType]
-        return array.array(arrayType, value).tolist()
+        data = array.array(arrayType)
+        data.frombytes(value)
+        return data.tolist()
 
     def close(self):
         for key in list(self.temp_store.keys()):
             self.flush(key)
 
+    def after_fork(self):
+        self.temp_store = {}
+        self.temp_store_lengths = {}
+        self.temp_store_bytes = {}
+
+
+# dtype ids of tables written before dtypes were stored as strings; this is
+# the order of np.sctypes, which no longer exists in NumPy 2
+legacy_numpy_types = [np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64,
+                      np.float16, np.float32, np.float64, np.longdouble, np.complex64, np.complex128,
+                      np.clongdouble, np.bool_, np.object_, np.bytes_, np.str_, np.void]
 
 class NumpyDataHandler(AbstractDataHandler):
     def __init__(self, tbl, fhandle, write_path):
         super(NumpyDataHandler, self).__init__(tbl, fhandle, write_path)
         self.supported_types.add(np.ndarray)
-        self.numpytype2byte = {}
-        self.byte2numpytype = {}
-        i = 0
-        for _, types in np.sctypes.items():
-            for t in types:
-                self.numpytype2byte[np.dtype(t)] = i
-                self.byte2numpytype[i] = np.dtype(t)
-                i+= 1
-
-    def set(self, key, value):
-        strType = self.numpytype2byte[value.dtype]
-        self.set_bytes(key, value.tobytes(), type(value), [strType, value.shape])
-
-    def get(self, key, start, length, vargs):
-        value = self.get_bytes(key, start, length)
-        if value is None: return None
-        else:
-            strType, shape = vargs
-            dtype = self.byte2numpytype[strType]
-            data = np.frombuffer(value, dtype=dtype).reshape(shape)
-            return data
+        self.byte2numpytype = dict((i, np.dtype(t)) for i, t in enumerate(legacy_numpy_types))
+        self.str2numpytype = {}
+
+    def encode_dtype(self, dtype):
+        # dtype.str keeps the byte order; structured dtypes are stored as their descr
+        if dtype.hasobject:
+            raise Exception('Arrays of Python objects are not supported!')
+        if dtype.fields is not None: return str(dtype.descr)
+        return dtype.str
+
+    def get_dtype(self, vargs):
+        strType = vargs[0]
+        if isinstance(strType, int): return self.byte2numpytype[strType]
+        if strType not in self.str2numpytype:
+            if strType.startswith('['): self.str2numpytype[strType] = np.dtype(ast.literal_eval(strType))
+            else: self.str2numpytype[strType] = np.dtype(strType)
+        return self.str2numpytype[strType]
+
+    def get_order(self, vargs):
+        return vargs[2] if len(vargs) > 2 else 'C'
+
+    def serialize(self, value):
+        # vargs are [dtype, shape, order]; Fortran ordered arrays are stored as they are
+        order = 'F' if value.flags.f_contiguous and not value.flags.c_contiguous else 'C'
+        return value.tobytes(order=order), type(value), [[self.encode_dtype(value.dtype), value.shape, order]]
+
+    def decode(self, value, vargs):
+        shape = vargs[1]
+        data = np.frombuffer(value, dtype=self.get_dtype(vargs)).reshape(shape, order=self.get_order(vargs))
+        return data
+
+    def itemsize(self, vargs):
+        return self.get_dtype(vargs).itemsize
+
+    def batched_decode(self, values, vargs):
+        if len(values) > 0 and isinstance(values[0], memoryview):
+            # mapped tables already yield zero-copy views for every value
+            return [self.decode(value, args) for value, args in zip(values, vargs)]
+
+        data = [None]*len(values)
+        groups = OrderedDict()
+        for i, args in enumerate(vargs):
+            groups.setdefault(args[0], []).append(i)
+
+        for strType, indices in groups.items():
+            # one np.frombuffer per dtype; the values are views into it
+            flat = np.frombuffer(b''.join([values[i] for i in indices]), dtype=self.get_dtype(vargs[indices[0]]))
+            offset = 0
+            for i in indices:
+                shape = vargs[i][1]
+                size = int(np.prod(shape))
+                data[i] = flat[offset:offset + size].reshape(shape, order=self.get_order(vargs[i]))
+                offset += size
+        return data
+
+    def batched_stack(self, triples, vargs, codecs):
+        # arrays of the same dtype and shape are copied straight from the read
+        # buffers into one preallocated array
+        dtype, shape = self.get_dtype(vargs[0]), tuple(vargs[0][1])
+        if any(self.get_dtype(args) != dtype or tuple(args[1]) != shape for args in vargs): return None
+        out = np.empty((len(triples),) + shape, dtype=dtype)
+        flat = out.reshape(-1).view(np.uint8)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        ranges = [(int(start), int(length)) for key, start, length in triples]
+        for start, end, indices in plan_reads(ranges, self.max_read_gap):
+            buffer = self.tbl.read(start, end - start)
+            for i in indices:
+                offset = ranges[i][0] - start
+                value = buffer[offset:offset + ranges[i][1]]
+                if codecs[i] != 0: value = self.decompress(value, vargs[i], codecs[i])
+                if self.get_order(vargs[i]) == 'C': flat[i*nbytes:(i + 1)*nbytes] = np.frombuffer(value, dtype=np.uint8)
+                else: out[i] = self.decode(value, vargs[i])
+        return out
+
+    def get_rows(self, key, start, length, vargs, codec, rows):
+        # rows is an int, a slice, a sequence of row indices or a boolean
+        # mask. Only the bytes
+        # of the requested rows of uncompressed C ordered arrays are read;
+        # other arrays are read as a whole and indexed.
+        shape = vargs[1]
+        if codec != 0 or self.get_order(vargs) != 'C' or len(shape) == 0:
+            return self.get(key, start, length, vargs, codec)[rows]
+        dtype = self.get_dtype(vargs)
+        row_shape = tuple(shape[1:])
+        row_bytes = int(np.prod(row_shape))*dtype.itemsize
+        if isinstance(rows, slice):
+            lower, upper, step = rows.indices(shape[0])
+            if step == 1:
+                count = max(upper - lower, 0)
+                value = self.tbl.read(start + lower*row_bytes, count*row_bytes)
+                return np.frombuffer(value, dtype=dtype).reshape((count,) + row_shape)
+            rows = range(lower, upper, step)
+        if isinstance(rows, (bool, np.bool_)):
+            # a scalar mask adds an axis like in NumPy
+            return self.get(key, start, length, vargs, codec)[rows]
+        if isinstance(rows, (int, np.integer)):
+            if rows < 0: rows += shape[0]
+            if rows < 0 or rows >= shape[0]:
+                raise IndexError('Row {0} is out of bounds for an array with {1} rows!'.format(rows, shape[0]))
+            value = self.tbl.read(start + int(rows)*row_bytes, row_bytes)
+            return np.frombuffer(value, dtype=dtype).reshape(row_shape)
+
+        indices = np.asarray(rows)
+        if indices.dtype == np.bool_:
+            # boolean masks select the rows where they are True
+            if indices.shape != (shape[0],):
+                raise IndexError('Boolean mask of shape {0} does not match an array with {1} rows!'.format(indices.shape, shape[0]))
+            indices = np.flatnonzero(indices)
+        indices = indices.astype(np.int64).reshape(-1)
+        indices = np.where(indices < 0, indices + shape[0], indices)
+        if np.any(indices < 0) or np.any(indices >= shape[0]):
+            raise IndexError('Rows are out of bounds for an array with {0} rows!'.format(shape[0]))
+        # one range per row; neighbouring rows are merged into one read
+        values = self.batched_get_bytes([(key, start + int(i)*row_bytes, row_bytes) for i in indices])
+        return np.frombuffer(b''.join(values), dtype=dtype).reshape((len(indices),) + row_shape)
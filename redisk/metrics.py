@@ -0,0 +1,83 @@
+import time
+import functools
+
+from collections import defaultdict
+
+# latency buckets are powers of two in microseconds, up to ~18 minutes
+num_buckets = 31
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0]*num_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[min(int(seconds*1e6).bit_length(), num_buckets - 1)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, q):
+        # upper bound of the bucket which holds the q-th percentile
+        rank = q/100.0*self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0: return min((1 << i)/1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum/self.count if self.count > 0 else 0.0,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99), 'max': self.max}
+
+
+class Metrics(object):
+    # counters and latency histograms of a table. Operations are named
+    # 'op.<method>', phases 'phase.<metadata|io|lock_wait|write|decompress|decode>',
+    # handlers 'decode.<handler>' and store round trips 'store.<command>'.
+    # Hooks are called as hook(kind, name, value) with kind 'count' or
+    # 'observe' to forward every event to another metrics system.
+    def __init__(self, hooks=None):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.hooks = list(hooks) if hooks is not None else []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+        for hook in self.hooks:
+            hook('count', name, value)
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+        for hook in self.hooks:
+            hook('observe', name, seconds)
+
+    def snapshot(self):
+        return {'counters': dict(self.counters),
+                'histograms': dict((name, h.snapshot()) for name, h in self.histograms.items())}
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+
+def timed(name):
+    # records the latency of a method if its object has metrics; without
+    # metrics the only cost is the extra call
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None: return func(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
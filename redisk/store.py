@@ -0,0 +1,383 @@
+import os
+import time
+import redis
+import sqlite3
+import threading
+import weakref
+
+# tables which talk to the same endpoint share one connection pool
+pools = {}
+
+def get_pool(host='localhost', port=6379, db=0, unix_socket_path=None, **kwargs):
+    pool_key = (host, port, db, unix_socket_path, tuple(sorted(kwargs.items())))
+    if pool_key not in pools:
+        if unix_socket_path is not None:
+            pools[pool_key] = redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                                   path=unix_socket_path, db=db, **kwargs)
+        else:
+            pools[pool_key] = redis.ConnectionPool(host=host, port=port, db=db, **kwargs)
+    return pools[pool_key]
+
+def decode(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+# metadata values stay binary; the replies of these commands are text
+decoders = {}
+decoders['hget'] = decode
+decoders['smembers'] = lambda values: set(decode(value) for value in values)
+decoders['lrange'] = lambda values: [decode(value) for value in values]
+decoders['zrangebylex'] = lambda values: [decode(value) for value in values]
+
+# the commands of the store; every store and its pipelines implement them
+commands = set(['get', 'mget', 'set', 'delete', 'exists', 'sadd', 'srem', 'smembers', 'rpush', 'lrange',
+                'hset', 'hget', 'hincrby', 'hdel', 'zadd', 'zrem', 'zscore', 'zcard', 'zrangebylex', 'flushdb'])
+
+def timed_command(metrics, command, method, d=None):
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        value = method(*args, **kwargs)
+        metrics.observe('store.' + command, time.perf_counter() - start)
+        metrics.count('store.commands')
+        return value if d is None else d(value)
+    return call
+
+class RedisPipeline(object):
+    def __init__(self, pipe, metrics=None):
+        self.pipe = pipe
+        self.replies = []
+        self.metrics = metrics
+
+    def __getattr__(self, command):
+        if command not in commands: raise AttributeError(command)
+        def queue(*args, **kwargs):
+            getattr(self.pipe, command)(*args, **kwargs)
+            self.replies.append(decoders.get(command))
+            return self
+        return queue
+
+    def execute(self):
+        if self.metrics is not None:
+            self.metrics.count('store.commands', len(self.replies))
+            start = time.perf_counter()
+        values = self.pipe.execute()
+        if self.metrics is not None: self.metrics.observe('store.pipeline', time.perf_counter() - start)
+        replies, self.replies = self.replies, []
+        return [value if d is None else d(value) for d, value in zip(replies, values)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pipe.reset()
+
+
+class RedisStore(object):
+    def __init__(self, host='localhost', port=6379, db=0, unix_socket_path=None, client=None, **kwargs):
+        # client replaces the pooled connection, e.g. with an in-process fakeredis
+        self.connection_kwargs = None
+        if client is None:
+            self.connection_kwargs = dict(kwargs, host=host, port=port, db=db, unix_socket_path=unix_socket_path)
+            client = redis.StrictRedis(connection_pool=get_pool(host, port, db, unix_socket_path, **kwargs))
+        self.client = client
+        # set by the table; every round trip is recorded as store.<command>
+        self.metrics = None
+
+    def __getattr__(self, command):
+        if command not in commands: raise AttributeError(command)
+        method = getattr(self.client, command)
+        d = decoders.get(command)
+        if self.metrics is not None: return timed_command(self.metrics, command, method, d)
+        if d is None: return method
+        return lambda *args, **kwargs: d(method(*args, **kwargs))
+
+    def pipeline(self, transaction=False):
+        # commands are queued and sent in one round trip by execute, in a
+        # MULTI/EXEC block if transaction is set
+        return RedisPipeline(self.client.pipeline(transaction=transaction), self.metrics)
+
+    def scan_iter(self, match, count=1000):
+        for key in self.client.scan_iter(match=match, count=count):
+            yield decode(key)
+
+    def zscan_iter(self, key):
+        for member, score in self.client.zscan_iter(key):
+            yield decode(member), score
+
+    def update(self, keys, func):
+        # func gets the current values of keys and returns the (key, value)
+        # pairs to set, which are only set if none of the keys changed since
+        def transaction(pipe):
+            items = func(pipe.mget(keys))
+            pipe.multi()
+            for key, value in items:
+                pipe.set(key, value)
+        self.client.transaction(transaction, *keys)
+
+    def close(self):
+        self.client.close()
+
+
+def to_bytes(value):
+    # values are encoded as redis-py encodes them
+    if isinstance(value, bytes): return value
+    if isinstance(value, str): return value.encode('utf8')
+    return repr(value).encode('utf8')
+
+def to_text(value):
+    return to_bytes(value).decode('utf8')
+
+schema = ['CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB) WITHOUT ROWID',
+          'CREATE TABLE IF NOT EXISTS sets (key TEXT, member TEXT, PRIMARY KEY (key, member)) WITHOUT ROWID',
+          'CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, member TEXT)',
+          'CREATE INDEX IF NOT EXISTS lists_key ON lists (key, id)',
+          'CREATE TABLE IF NOT EXISTS hashes (key TEXT, field TEXT, value TEXT, PRIMARY KEY (key, field)) WITHOUT ROWID',
+          # members are blobs so that they compare bytewise like in Redis
+          'CREATE TABLE IF NOT EXISTS zsets (key TEXT, member BLOB, score REAL, PRIMARY KEY (key, member)) WITHOUT ROWID']
+sqlite_tables = ['kv', 'sets', 'lists', 'hashes', 'zsets']
+read_commands = set(['get', 'mget', 'exists', 'smembers', 'lrange', 'hget', 'zscore', 'zcard', 'zrangebylex'])
+# SQLite limits the number of parameters of a statement
+max_variables = 500
+
+class SQLitePipeline(object):
+    def __init__(self, store):
+        self.store = store
+        self.queued = []
+
+    def __getattr__(self, command):
+        if command not in commands: raise AttributeError(command)
+        def queue(*args, **kwargs):
+            self.queued.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        queued, self.queued = self.queued, []
+        return self.store.execute(queued)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.queued = []
+
+
+# SQLite connections must not be used across a fork; children reconnect
+sqlite_stores = weakref.WeakSet()
+
+def reset_sqlite_after_fork():
+    for store in list(sqlite_stores):
+        store.after_fork()
+
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=reset_sqlite_after_fork)
+
+class SQLiteStore(object):
+    # embedded store for single node deployments: a SQLite database in WAL
+    # mode which implements the commands of the Redis store. Pipelines run in
+    # one transaction.
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.connection = None
+        self.connection_kwargs = None
+        self.metrics = None
+        # connections of the parent process, which the child must not close
+        self.inherited = []
+        sqlite_stores.add(self)
+
+    def __reduce__(self):
+        return SQLiteStore, (self.path, self.timeout)
+
+    def after_fork(self):
+        if self.connection is not None: self.inherited.append(self.connection)
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        if self.connection is not None: return self.connection
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.path))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)))
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            self.connection.execute(statement)
+        return self.connection
+
+    def __getattr__(self, command):
+        if command not in commands: raise AttributeError(command)
+        if self.metrics is not None:
+            return timed_command(self.metrics, command, lambda *args, **kwargs: self.execute([(command, args, kwargs)], False)[0])
+        return lambda *args, **kwargs: self.execute([(command, args, kwargs)], False)[0]
+
+    def pipeline(self, transaction=False):
+        # pipelines always run in a transaction
+        return SQLitePipeline(self)
+
+    def execute(self, queued, pipeline=True):
+        # reads run in a deferred transaction; writes take the write lock
+        # right away so that a transaction never has to be upgraded
+        read_only = all(command in read_commands for command, args, kwargs in queued)
+        if pipeline and self.metrics is not None:
+            self.metrics.count('store.commands', len(queued))
+            start = time.perf_counter()
+        with self.lock:
+            cursor = self.connect().cursor()
+            cursor.execute('BEGIN' if read_only else 'BEGIN IMMEDIATE')
+            try:
+                results = [getattr(self, 'do_' + command)(cursor, *args, **kwargs) for command, args, kwargs in queued]
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        if pipeline and self.metrics is not None: self.metrics.observe('store.pipeline', time.perf_counter() - start)
+        return results
+
+    def update(self, keys, func):
+        with self.lock:
+            cursor = self.connect().cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for key, value in func(self.do_mget(cursor, keys)):
+                    self.do_set(cursor, key, value)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    def scan_iter(self, match, count=1000):
+        # keys of all types which match the glob pattern, in pages of count keys
+        query = ' UNION '.join(['SELECT key FROM {0} WHERE key GLOB ? AND key > ?'.format(name) for name in sqlite_tables])
+        last = ''
+        while True:
+            with self.lock:
+                rows = self.connect().execute(query + ' ORDER BY key LIMIT ?', [match, last]*len(sqlite_tables) + [count]).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < count: return
+            last = rows[-1][0]
+
+    def zscan_iter(self, key, count=1000):
+        last = b''
+        while True:
+            with self.lock:
+                rows = self.connect().execute('SELECT member, score FROM zsets WHERE key = ? AND member > ? ORDER BY member LIMIT ?',
+                                              (key, last, count)).fetchall()
+            for member, score in rows:
+                yield bytes(member).decode('utf8'), score
+            if len(rows) < count: return
+            last = bytes(rows[-1][0])
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def do_get(self, cursor, key):
+        row = cursor.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def do_mget(self, cursor, keys):
+        values = {}
+        for i in range(0, len(keys), max_variables):
+            batch = keys[i:i + max_variables]
+            query = 'SELECT key, value FROM kv WHERE key IN ({0})'.format(','.join(['?']*len(batch)))
+            for key, value in cursor.execute(query, batch):
+                values[key] = bytes(value)
+        return [values.get(key) for key in keys]
+
+    def do_set(self, cursor, key, value):
+        cursor.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, to_bytes(value)))
+        return True
+
+    def do_delete(self, cursor, *keys):
+        deleted = 0
+        for key in keys:
+            removed = 0
+            for name in sqlite_tables:
+                removed += cursor.execute('DELETE FROM {0} WHERE key = ?'.format(name), (key,)).rowcount
+            deleted += 1 if removed > 0 else 0
+        return deleted
+
+    def do_exists(self, cursor, *keys):
+        query = ' UNION ALL '.join(['SELECT 1 FROM {0} WHERE key = ?'.format(name) for name in sqlite_tables])
+        return sum([1 for key in keys if cursor.execute(query + ' LIMIT 1', [key]*len(sqlite_tables)).fetchone() is not None])
+
+    def do_sadd(self, cursor, key, *values):
+        return sum([cursor.execute('INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)', (key, to_text(value))).rowcount
+                    for value in values])
+
+    def do_srem(self, cursor, key, *values):
+        return sum([cursor.execute('DELETE FROM sets WHERE key = ? AND member = ?', (key, to_text(value))).rowcount
+                    for value in values])
+
+    def do_smembers(self, cursor, key):
+        return set(row[0] for row in cursor.execute('SELECT member FROM sets WHERE key = ?', (key,)))
+
+    def do_rpush(self, cursor, key, *values):
+        cursor.executemany('INSERT INTO lists (key, member) VALUES (?, ?)', [(key, to_text(value)) for value in values])
+        return cursor.execute('SELECT COUNT(*) FROM lists WHERE key = ?', (key,)).fetchone()[0]
+
+    def do_lrange(self, cursor, key, start, stop):
+        members = [row[0] for row in cursor.execute('SELECT member FROM lists WHERE key = ? ORDER BY id', (key,))]
+        # the stop index is inclusive like in Redis
+        if stop < 0: stop += len(members)
+        return members[max(start + len(members) if start < 0 else start, 0):stop + 1]
+
+    def do_hset(self, cursor, key, field, value):
+        new = cursor.execute('SELECT 1 FROM hashes WHERE key = ? AND field = ?', (key, to_text(field))).fetchone() is None
+        cursor.execute('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)', (key, to_text(field), to_text(value)))
+        return 1 if new else 0
+
+    def do_hget(self, cursor, key, field):
+        row = cursor.execute('SELECT value FROM hashes WHERE key = ? AND field = ?', (key, to_text(field))).fetchone()
+        return None if row is None else row[0]
+
+    def do_hincrby(self, cursor, key, field, amount=1):
+        value = int(self.do_hget(cursor, key, field) or 0) + amount
+        cursor.execute('INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)', (key, to_text(field), str(value)))
+        return value
+
+    def do_hdel(self, cursor, key, *fields):
+        return sum([cursor.execute('DELETE FROM hashes WHERE key = ? AND field = ?', (key, to_text(field))).rowcount
+                    for field in fields])
+
+    def do_zadd(self, cursor, key, mapping):
+        added = 0
+        for member, score in mapping.items():
+            member = to_bytes(member)
+            if cursor.execute('SELECT 1 FROM zsets WHERE key = ? AND member = ?', (key, member)).fetchone() is None:
+                added += 1
+            cursor.execute('INSERT OR REPLACE INTO zsets (key, member, score) VALUES (?, ?, ?)', (key, member, score))
+        return added
+
+    def do_zrem(self, cursor, key, *members):
+        return sum([cursor.execute('DELETE FROM zsets WHERE key = ? AND member = ?', (key, to_bytes(member))).rowcount
+                    for member in members])
+
+    def do_zscore(self, cursor, key, member):
+        row = cursor.execute('SELECT score FROM zsets WHERE key = ? AND member = ?', (key, to_bytes(member))).fetchone()
+        return None if row is None else row[0]
+
+    def do_zcard(self, cursor, key):
+        return cursor.execute('SELECT COUNT(*) FROM zsets WHERE key = ?', (key,)).fetchone()[0]
+
+    def do_zrangebylex(self, cursor, key, min, max, start=None, num=None):
+        # bounds are '-', '+' or start with '[' (inclusive) or '(' (exclusive)
+        query = 'SELECT member FROM zsets WHERE key = ?'
+        args = [key]
+        for bound, inclusive, exclusive in [(to_bytes(min), '>=', '>'), (to_bytes(max), '<=', '<')]:
+            if bound in [b'-', b'+']: continue
+            query += ' AND member {0} ?'.format(inclusive if bound[:1] == b'[' else exclusive)
+            args.append(bound[1:])
+        query += ' ORDER BY member'
+        if num is not None:
+            query += ' LIMIT ? OFFSET ?'
+            args += [num, start or 0]
+        return [bytes(row[0]).decode('utf8') for row in cursor.execute(query, args)]
+
+    def do_flushdb(self, cursor):
+        for name in sqlite_tables:
+            cursor.execute('DELETE FROM {0}'.format(name))
+        return True
@@ -34,3 +34,31 @@ class Types(object):
             raise Exception('String type {0} not supported!'.format(str_value))
         else:
             return self.strType2type[str_value]
+
+
+def plan_reads(ranges, max_gap=0):
+    # sorts (start, length) ranges by offset and merges ranges which are at
+    # most max_gap bytes apart into a single read; returns a list of
+    # [start, end, indices] with indices pointing into ranges
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    plan = []
+    for i in order:
+        start, length = ranges[i]
+        end = start + length
+        if len(plan) > 0 and start <= plan[-1][1] + max_gap:
+            plan[-1][1] = max(plan[-1][1], end)
+            plan[-1][2].append(i)
+        else:
+            plan.append([start, end, [i]])
+    return plan
+
+# the start offset stored in the metadata addresses a file of the table in its
+# upper bits and the position within that file in the lower bits
+OFFSET_BITS = 40
+MAX_SEGMENT_SIZE = 1 << OFFSET_BITS
+
+def pack_offset(segment_id, offset):
+    return (segment_id << OFFSET_BITS) | offset
+
+def unpack_offset(start):
+    return start >> OFFSET_BITS, start & (MAX_SEGMENT_SIZE - 1)
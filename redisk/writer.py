@@ -0,0 +1,259 @@
+import os
+import errno
+import time
+import atexit
+import weakref
+import threading
+
+from filelock import FileLock
+
+from redisk.util import pack_offset, MAX_SEGMENT_SIZE
+
+fsync_policies = set(['none', 'batch', 'interval'])
+
+# writers of this process which have appended; their buffers are flushed at exit
+writers = weakref.WeakSet()
+
+def flush_writers():
+    for writer in list(writers):
+        writer.flush()
+        writer.sync(force=True)
+
+atexit.register(flush_writers)
+# buffers of the parent are flushed by the parent
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=writers.clear)
+
+def run_flusher(ref, stop, period):
+    # holds the writer only while it flushes, so that it can be collected
+    while not stop.wait(period):
+        writer = ref()
+        if writer is None: return
+        writer.tick()
+        del writer
+
+class AppendWriter(object):
+    def __init__(self, tbl, path, buffer_size=0, flush_interval=None, fsync='none', fsync_interval=1.0,
+                 concurrent=False):
+        assert fsync in fsync_policies, 'fsync policy needs to be one of {0}!'.format(sorted(fsync_policies))
+        self.tbl = tbl
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        # high timeout of 10 seconds in the case somebody dumps a large numpy array
+        self.lock = FileLock(path + '.lock', timeout=10)
+        self.thread_lock = threading.Lock()
+        # concurrent writers append to a segment of their own and only take
+        # the lock of that segment, which is shared with compactions only
+        self.concurrent = concurrent
+        self.segment_locks = {}
+        # locks which are held while writing
+        self.held = []
+        self.fhandle = None
+        self.segment_id = None
+        self.pending = []
+        self.pending_bytes = 0
+        # metadata of values which are written but not yet synced to disk
+        self.unsynced = []
+        self.last_flush = time.time()
+        self.last_sync = time.time()
+        # guards the buffers; flushes hold it while writing so that batches
+        # are published in the order they were appended
+        self.buffer_lock = threading.RLock()
+        # flushes and syncs on time if no further append follows
+        self.flusher = None
+        self.stop = threading.Event()
+        self.started = False
+
+    def open(self):
+        # appends go to the active segment of the table until a roll or a
+        # compaction seals it, or a compaction removes it. Needs to be called
+        # with the lock held.
+        if self.fhandle is not None:
+            if os.fstat(self.fhandle.fileno()).st_nlink > 0 and not self.tbl.is_marked_sealed(self.segment_id):
+                return self.fhandle
+            # unsynced metadata can point into the old segment
+            self.fhandle.flush()
+            if self.fsync != 'none': os.fsync(self.fhandle.fileno())
+            self.fhandle.close()
+            self.fhandle = None
+        if self.concurrent: return self.claim()
+        self.segment_id = self.tbl.active_segment()
+        self.fhandle = open(self.tbl.segment_path(self.segment_id), 'ab')
+        return self.fhandle
+
+    def claim(self):
+        # concurrent writers claim a segment of their own and take its lock
+        # before the first write: a compaction seals and removes segments
+        # which it can lock and which have no published values, so the claimed
+        # segment is only used if it is still there and unsealed once its
+        # lock is held
+        while True:
+            segment_id = self.tbl.claim_segment()
+            lock = self.segment_lock(segment_id)
+            lock.acquire()
+            try:
+                fd = os.open(self.tbl.segment_path(segment_id), os.O_WRONLY | os.O_APPEND)
+                if not self.tbl.is_marked_sealed(segment_id): break
+                os.close(fd)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    lock.release()
+                    raise
+            lock.release()
+        self.held.append(lock)
+        self.segment_id = segment_id
+        self.fhandle = os.fdopen(fd, 'ab')
+        return self.fhandle
+
+    def roll(self, fsync=False):
+        # seals the active segment and starts the next one
+        self.fhandle.flush()
+        if fsync: os.fsync(self.fhandle.fileno())
+        self.fhandle.close()
+        self.fhandle = None
+        self.tbl.seal(self.segment_id)
+        if self.concurrent: return self.claim()
+        self.segment_id = self.tbl.claim_segment()
+        self.lock_segment(self.segment_id)
+        self.fhandle = open(self.tbl.segment_path(self.segment_id), 'ab')
+        return self.fhandle
+
+    def acquire(self):
+        # takes the table lock and the lock of the segment to append to, or
+        # for concurrent writers only the lock of their segment, and returns
+        # the segment. The newest segment may be one which a concurrent
+        # writer claimed, so regular writers hold its lock as well.
+        if self.concurrent:
+            if self.fhandle is None: return self.claim()
+            self.lock_segment(self.segment_id)
+            return self.open()
+        self.lock.acquire()
+        self.held.append(self.lock)
+        fhandle = self.open()
+        self.lock_segment(self.segment_id)
+        return fhandle
+
+    def lock_segment(self, segment_id):
+        lock = self.segment_lock(segment_id)
+        lock.acquire()
+        self.held.append(lock)
+
+    def release(self):
+        # the locks of all segments of a write are held until its metadata is
+        # published, also of those it rolled over from
+        while len(self.held) > 0:
+            self.held.pop().release()
+
+    def segment_lock(self, segment_id):
+        if segment_id not in self.segment_locks:
+            self.segment_locks[segment_id] = FileLock(self.tbl.segment_path(segment_id) + '.wlock', timeout=10)
+        return self.segment_locks[segment_id]
+
+    def append(self, records):
+        # records are (key, value, type_value, args, codec) tuples
+        if not self.started: self.start()
+        with self.buffer_lock:
+            for record in records:
+                self.pending.append(record)
+                self.pending_bytes += len(record[1])
+            if self.pending_bytes >= self.buffer_size:
+                self.flush()
+            elif self.flush_interval is not None and time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def start(self):
+        with self.buffer_lock:
+            if self.started: return
+            self.started = True
+            writers.add(self)
+            intervals = []
+            if self.buffer_size > 0 and self.flush_interval is not None: intervals.append(self.flush_interval)
+            if self.fsync == 'interval': intervals.append(self.fsync_interval)
+            if len(intervals) == 0: return
+            self.flusher = threading.Thread(target=run_flusher, args=(weakref.ref(self), self.stop, max(min(intervals)/4.0, 0.01)))
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def tick(self):
+        with self.buffer_lock:
+            if len(self.pending) > 0 and self.flush_interval is not None and time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+            else:
+                self.sync()
+
+    def flush(self):
+        with self.buffer_lock:
+            if len(self.pending) > 0:
+                records, self.pending, self.pending_bytes = self.pending, [], 0
+                if self.fsync == 'interval':
+                    # published by sync once the bytes are on disk
+                    self.unsynced.extend(self.write(records))
+                else:
+                    self.write(records, self.fsync == 'batch', self.tbl.set_many)
+            self.last_flush = time.time()
+            self.sync()
+
+    def write(self, records, fsync=False, publish=None):
+        # writes the records unbuffered and returns their metadata. If publish
+        # is given, it receives the metadata while the lock is still held so
+        # that a compaction never misses values which are already written.
+        metrics = self.tbl.metrics
+        if metrics is not None: start = time.perf_counter()
+        with self.thread_lock:
+            # process safe write; offsets are only known once the lock is held
+            try:
+                fhandle = self.acquire()
+                if metrics is not None:
+                    locked = time.perf_counter()
+                    metrics.observe('phase.lock_wait', locked - start)
+                fhandle.seek(0, 2)
+                offset = fhandle.tell()
+                metadata = []
+                for key, value, type_value, args, codec in records:
+                    # a value larger than the segment size gets a segment of its own
+                    if offset > 0 and offset + len(value) > self.tbl.segment_size:
+                        fhandle = self.roll(fsync or self.fsync != 'none')
+                        offset = 0
+                    if offset + len(value) > MAX_SEGMENT_SIZE:
+                        raise Exception('Value for key {0} is too large for a segment!'.format(key))
+                    fhandle.write(value)
+                    vargs = args[0] if len(args) > 0 else []
+                    metadata.append((key, pack_offset(self.segment_id, offset), len(value), type_value, vargs, codec))
+                    offset += len(value)
+                fhandle.flush()
+                if fsync: os.fsync(fhandle.fileno())
+                if metrics is not None:
+                    metrics.observe('phase.write', time.perf_counter() - locked)
+                    metrics.count('io.bytes_written', sum([record[2] for record in metadata]))
+                if publish is not None: publish(metadata)
+            finally:
+                self.release()
+        return metadata
+
+    def sync(self, force=False):
+        # metadata of the interval policy is only published after the bytes
+        # behind it are synced to disk
+        with self.buffer_lock:
+            if len(self.unsynced) == 0: return
+            if not force and time.time() - self.last_sync < self.fsync_interval: return
+            with self.thread_lock:
+                if self.fhandle is not None: os.fsync(self.fhandle.fileno())
+            self.last_sync = time.time()
+            metadata, self.unsynced = self.unsynced, []
+            self.tbl.set_many(metadata)
+
+    def close(self):
+        # the flusher is started again by the next append
+        self.stop.set()
+        with self.buffer_lock:
+            self.stop = threading.Event()
+            self.flusher = None
+            self.started = False
+            self.flush()
+            self.sync(force=True)
+            with self.thread_lock:
+                if self.fhandle is not None:
+                    self.fhandle.close()
+                    self.fhandle = None
@@ -18,6 +18,7 @@ setup(
     keywords = "bash",
     url = "http://packages.python.org/minimal-IR",
     packages=['redisk', 'tests'],
+    entry_points={'console_scripts': ['redisk = redisk.__main__:main']},
     long_description=read('README.md'),
     classifiers=[
         "Development Status :: 1 - Alpha",
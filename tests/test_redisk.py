@@ -2,10 +2,14 @@ from __future__ import unicode_literals, print_function
 
 import os
 import shutil
+import asyncio
+import multiprocessing
 import pytest
 import numpy as np
+import ujson
 
 from redisk import Table, Redisk
+from redisk.util import plan_reads
 
 from uuid import uuid4
 from os.path import join, exists
@@ -85,6 +89,750 @@ def test_string_handler_batched_get():
             assert value == expected, 'String value from redisk different from the expected value!'
     db.delete_db()
 
+def test_table_get_many():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    for i, key in enumerate(keys):
+        db.set(key, i)
+
+    missing = str(uuid4())
+    values = tbl.get_many(keys + [missing])
+    assert len(values) == repeats + 1
+    assert values[-1] is None, 'Missing key should yield None!'
+    for key, value in zip(keys, values):
+        assert value == tbl.get(key), 'Bulk metadata different from single lookup!'
+    assert tbl.get_many([]) == []
+    db.delete_db()
+
+def test_plan_reads():
+    ranges = [(100, 10), (0, 10), (10, 5), (20, 5), (1000, 1)]
+    plan = plan_reads(ranges, max_gap=5)
+    assert [(start, end) for start, end, indices in plan] == [(0, 25), (100, 110), (1000, 1001)]
+    assert plan[0][2] == [1, 2, 3]
+    plan = plan_reads(ranges, max_gap=0)
+    assert len(plan) == 4, 'Only adjacent ranges should be merged without a gap!'
+
+def test_batched_get_coalesced():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl, max_read_gap=16)
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    arrays = np.random.rand(repeats, 7)
+    for key, arr in zip(keys, arrays):
+        db.set(key, arr)
+
+    # reversed order forces the planner to restore the caller's order
+    values = db.batched_get(keys[::-1])
+    for value, arr in zip(values, arrays[::-1]):
+        np.testing.assert_array_equal(value, arr, 'Arrays are not equal!')
+    db.delete_db()
+
+def test_batched_get_mixed_types():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    expected = ['a', 3, {'x': 1}, [1, 2, 3], ['aa', 'bb'], np.random.rand(3, 2),
+                np.random.randint(0, 10, size=(4,)), b'bytes', np.random.rand(5), {'y': [1]}]
+    keys = [str(uuid4()) for value in expected]
+    for key, value in zip(keys, expected):
+        db.set(key, value)
+
+    appended = str(uuid4())
+    for i in range(10):
+        db.append(appended, i, 3)
+    db.close()
+
+    missing = str(uuid4())
+    values = db.batched_get(keys + [missing, appended])
+    assert values[-2] is None, 'Missing keys should yield None!'
+    assert values[-1] == list(range(10)), 'Appended list is not resolved!'
+    for value, exp in zip(values, expected):
+        if isinstance(exp, np.ndarray):
+            np.testing.assert_array_equal(value, exp, 'Arrays are not equal!')
+        else:
+            assert value == exp, 'Batched value different from the expected value!'
+    db.delete_db()
+
+def test_store():
+    tbl1 = Table(name='test', base_dir=base_path, host='127.0.0.1', port=6379)
+    tbl2 = Table(name='test2', base_dir=base_path, host='127.0.0.1', port=6379)
+    assert tbl1.store.client.connection_pool is tbl2.store.client.connection_pool, 'Tables do not share the pool!'
+    assert tbl1.store.client.connection_pool is not tbl.store.client.connection_pool
+
+    # metadata stays binary, the replies of set, list and hash commands are text
+    pipe = tbl1.store.pipeline()
+    pipe.set('test/binary', b'\x01\xff').sadd('test/set', 'a').hset('test/hash', 'k', 'v')
+    pipe.get('test/binary').smembers('test/set').hget('test/hash', 'k')
+    assert pipe.execute()[3:] == [b'\x01\xff', set(['a']), 'v']
+    assert tbl1.store.smembers('test/set') == set(['a'])
+    Redisk(tbl1).delete_db()
+
+def test_sqlite_store():
+    tbl = Table(name='test', base_dir=base_path, store='sqlite')
+    db = Redisk(tbl)
+
+    arr = np.random.rand(3, 2)
+    db.set('a', 'abc', reference_id='ref')
+    db.set('a', arr, col='features', reference_id='ref')
+    db.set_many([('b', 1), ('c/x', {'k': [1, 2]})])
+    for i in range(7):
+        db.append('list', i, 2)
+    db.sadd('set', 0.5)
+    db.close()
+
+    assert db.get('a') == 'abc' and db.get('b') == 1 and db.get('c', col='x') == {'k': [1, 2]}
+    np.testing.assert_array_equal(db.get('a', col='features'), arr, 'Arrays are not equal!')
+    assert db.get('list') == list(range(7)) and db.get_slice('list', 2, 5) == [2, 3, 4]
+    assert db.batched_get(['b', 'missing', 'list']) == [1, None, list(range(7))]
+    assert db.get_with_reference('ref')[0] == 'abc' and db.get_reference('a/features') == 'ref'
+    assert db.get_members('set') == set(['0.5'])
+    assert list(db.keys()) == ['a', 'b', 'c', 'list'] and db.columns() == ['features', 'x']
+    assert set(db.key_col_pairs()) == set([('a', None), ('a', 'features'), ('b', None), ('c', 'x'), ('list', None)])
+
+    db.set('b', 2)
+    assert db.delete('c', col='x')
+    assert db.compact() > 0
+    assert db.get('b') == 2 and db.get('list') == list(range(7)) and not db.exists('c/x')
+    assert db.count() == 3
+
+    # the metadata is persisted in the table directory
+    db2 = Redisk(Table(name='test', base_dir=base_path, store='sqlite'))
+    assert db2.get('a') == 'abc' and db2.get('list') == list(range(7))
+    db.delete_db()
+
+def test_bulk():
+    from redisk.bulk import load, export, read_file
+    from redisk.__main__ import main
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    items = OrderedDict()
+    for i in range(50):
+        items['k{0}'.format(i)] = [str(i), i, list(range(i + 1)), {'i': i}, np.random.rand(i + 1)][i % 5]
+    assert load(db, items, processes=2, batch_size=7, compression='zlib') == 50
+    exported = list(export(db, processes=2, batch_size=7))
+    assert [key for key, value in exported] == list(items.keys()), 'Keys are not exported in offset order!'
+    for key, value in exported:
+        if isinstance(value, np.ndarray): np.testing.assert_array_equal(value, items[key], 'Arrays are not equal!')
+        else: assert value == items[key], 'Exported value different from the loaded value!'
+
+    path = join(base_path, 'input')
+    with open(path + '.jsonl', 'w') as f:
+        f.write('{"key": "j1", "value": [1, 2], "col": "a"}\n{"key": "j2", "value": "b"}\n')
+    with open(path + '.csv', 'w') as f:
+        f.write('key,x,y\nc1,1,2\n')
+    np.save(path + '.npy', np.arange(6).reshape(3, 2))
+    assert list(read_file(path + '.jsonl')) == [('j1', [1, 2]), ('j1/col', 'a'), ('j2', 'b')]
+    assert list(read_file(path + '.csv')) == [('c1/x', '1'), ('c1/y', '2')]
+    main(['load', 'test', base_path, path + '.jsonl', '--processes', '0'])
+    main(['load', 'test', base_path, path + '.npy', '--processes', '0'])
+    np.testing.assert_array_equal(db.get('2'), [4, 5], 'Arrays are not equal!')
+    assert db.get('j1', col='col') == 'a'
+
+    main(['export', 'test', base_path, path + '.out.jsonl', '--processes', '1'])
+    with open(path + '.out.jsonl') as f:
+        lines = [ujson.loads(line) for line in f]
+    assert len(lines) == 50 + 3 + 3 and {'key': 'j2', 'value': 'b'} in lines
+    db.delete_db()
+
+def test_metrics():
+    from redisk.metrics import Metrics
+    events = []
+    metrics = Metrics(hooks=[lambda kind, name, value: events.append((kind, name))])
+    tbl = Table(name='test', base_dir=base_path, metrics=metrics)
+    db = Redisk(tbl)
+
+    db.set('a', 'abc', compression='zlib')
+    db.set_many([('b', [1, 2]), ('c', np.arange(3))])
+    assert db.get('a') == 'abc'
+    db.batched_get(['a', 'b', 'c'])
+    snapshot = db.metrics_snapshot()
+    histograms, counters = snapshot['histograms'], snapshot['counters']
+    for name in ['op.set', 'op.set_many', 'op.get', 'op.batched_get', 'phase.metadata', 'phase.io',
+                 'phase.lock_wait', 'phase.write', 'phase.decompress', 'phase.decode', 'decode.StringDataHandler',
+                 'decode.NumpyDataHandler', 'store.pipeline', 'store.mget']:
+        assert histograms[name]['count'] > 0, 'No latencies for {0}!'.format(name)
+    assert histograms['op.get']['count'] == 1 and histograms['op.batched_get']['count'] == 1
+    assert histograms['op.get']['p50'] <= histograms['op.get']['max']
+    assert counters['metadata.keys'] == 4 and counters['values.StringDataHandler'] == 2
+    assert counters['io.bytes_read'] == sum([tbl.get(key)[1] for key in ['a', 'b', 'c']]) + tbl.get('a')[1]
+    assert counters['io.bytes_written'] > 0 and counters['store.commands'] > 0
+    assert ('observe', 'op.get') in events and ('count', 'io.bytes_read') in events
+
+    # a new key is published and registered in one round trip
+    metrics.reset()
+    db.set('d', 'new', col='c')
+    assert metrics.snapshot()['histograms']['store.pipeline']['count'] == 1
+    assert db.columns() == ['c'] and 'd' in list(db.keys())
+
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'histograms': {}}
+    assert Redisk(Table(name='test', base_dir=base_path)).metrics_snapshot() is None
+    db.delete_db()
+
+def test_threaded_reads():
+    from concurrent.futures import ThreadPoolExecutor
+    for use_mmap, cache_bytes in [(False, 0), (True, 0), (False, 1 << 20)]:
+        tbl = Table(name='test', base_dir=base_path, use_mmap=use_mmap)
+        db = Redisk(tbl, cache_bytes=cache_bytes)
+        items = OrderedDict()
+        for i in range(500):
+            items[str(i)] = [str(uuid4()), i, list(range(i % 7 + 1)), np.random.rand(i % 5 + 1)][i % 4]
+        db.set_many(items)
+        db.flush()
+        keys = list(items.keys())
+
+        def check(seed):
+            rng = np.random.RandomState(seed)
+            for i in rng.randint(0, len(keys), 200):
+                value = db.get(keys[i])
+                if isinstance(value, np.ndarray): assert np.array_equal(value, items[keys[i]])
+                else: assert value == items[keys[i]], 'Threads read corrupt data!'
+            return True
+        with ThreadPoolExecutor(8) as executor:
+            assert all(executor.map(check, range(16)))
+
+        shuffled = list(np.random.permutation(keys)) + ['missing']
+        expected = db.batched_get(shuffled)
+        values = db.parallel_batched_get(shuffled, threads=4, min_batch_size=16)
+        assert len(values) == len(expected) and values[-1] is None
+        for value, other in zip(values, expected):
+            if isinstance(value, np.ndarray): np.testing.assert_array_equal(value, other, 'Arrays are not equal!')
+            else: assert value == other, 'Parallel batched get different from batched get!'
+        db.close()
+        db.delete_db()
+
+def read_in_child(args):
+    db, keys = args
+    return [db.get(key) for key in keys]
+
+def test_fork_and_pickle():
+    import pickle
+    for store in [None, 'sqlite']:
+        tbl = Table(name='test', base_dir=base_path, use_mmap=True, store=store)
+        db = Redisk(tbl, cache_bytes=1 << 20)
+        items = OrderedDict((str(i), [str(uuid4()), i, list(range(i % 5 + 1))][i % 3]) for i in range(100))
+        db.set_many(items)
+        db.flush()
+        keys = list(items.keys())
+        # handles, mappings and connections of the parent are open before the fork
+        assert db.batched_get(keys) == list(items.values())
+
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(2) as pool:
+            results = pool.map(read_in_child, [(db, keys[i::4]) for i in range(4)])
+        for i, values in enumerate(results):
+            assert values == [items[key] for key in keys[i::4]], 'Pool worker read different values!'
+
+        def fork_reader():
+            child = os.fork()
+            if child == 0:
+                ok = db.batched_get(keys) == list(items.values())
+                db.set('child', 'written by child')
+                db.flush()
+                os._exit(0 if ok else 1)
+            return os.waitpid(child, 0)[1]
+        assert fork_reader() == 0, 'Child read different values after fork!'
+        assert db.get('child') == 'written by child'
+
+        # only the arguments of the table are pickled, not its handles or cache
+        data = pickle.dumps(db)
+        assert len(data) < 1024
+        copy = pickle.loads(data)
+        assert copy.cache_bytes == db.cache_bytes and copy.tbl.open_args == db.tbl.open_args
+        assert copy.get(keys[1]) == items[keys[1]]
+        copy.close()
+        db.close()
+        db.delete_db()
+
+    from redisk.store import SQLiteStore
+    tbl = Table(name='test', base_dir=base_path, store=SQLiteStore(join(base_path, 'custom.sqlite')))
+    with pytest.raises(pickle.PicklingError):
+        pickle.dumps(Redisk(tbl))
+    tbl.store.close()
+
+def test_set_many():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    items = [(str(uuid4()), str(uuid4())) for i in range(repeats)]
+    items += [(str(uuid4()), np.random.rand(3)), (str(uuid4()), [1, 2]), (str(uuid4()), {'a': 1})]
+    db.set_many(items)
+    for key, expected in items:
+        if isinstance(expected, np.ndarray):
+            np.testing.assert_array_equal(db.get(key), expected, 'Arrays are not equal!')
+        else:
+            assert db.get(key) == expected, 'Value from set_many different from the expected value!'
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    with db.writer(batch_size=3) as writer:
+        for i, key in enumerate(keys):
+            writer.set(key, i, col='c')
+    for i, key in enumerate(keys):
+        assert db.get(key, col='c') == i, 'Value from writer different from the expected value!'
+    db.delete_db()
+
+def test_buffered_writer():
+    tbl = Table(name='test', base_dir=base_path, buffer_size=1024, fsync='batch')
+    db = Redisk(tbl)
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    for i, key in enumerate(keys):
+        db.set(key, i)
+    # metadata is only published once the buffer is written
+    assert not db.exists(keys[0]), 'Buffered value should not be visible before a flush!'
+    db.flush()
+    for i, key in enumerate(keys):
+        assert db.get(key) == i, 'Int value from redisk different from the expected value!'
+
+    tbl = Table(name='test', base_dir=base_path, buffer_size=8)
+    db = Redisk(tbl)
+    key = str(uuid4())
+    db.set(key, 'a value larger than the buffer')
+    assert db.get(key) == 'a value larger than the buffer'
+    db.delete_db()
+
+def test_legacy_metadata():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    key1, key2 = str(uuid4()), str(uuid4())
+    arr = np.random.rand(3, 2)
+    db.set(key1, 'abc')
+    db.set(key2, arr)
+    start, length, type_value, pointers, vargs, codec = tbl.get(key2)
+    assert len(tbl.store.get(join('test', key1))) == 19, 'Metadata without vargs should only be a header!'
+
+    # records as written by older versions
+    start1, length1 = tbl.get(key1)[:2]
+    tbl.store.set(join('test', key1), '{0} {1} 1 [] []'.format(start1, length1))
+    # float64 had the id 10 in the old dtype table
+    tbl.store.set(join('test', key2), '{0} {1} 4 [] {2}'.format(start, length, '[10,[3,2]]'))
+    assert db.get(key1) == 'abc', 'Legacy metadata cannot be read!'
+    np.testing.assert_array_equal(db.get(key2), arr, 'Arrays are not equal!')
+
+    assert tbl.migrate_metadata() == 2
+    assert tbl.store.get(join('test', key1))[:1] == b'\x01', 'Metadata was not migrated!'
+    assert db.get(key1) == 'abc'
+    np.testing.assert_array_equal(db.get(key2), arr, 'Arrays are not equal!')
+    assert tbl.migrate_metadata() == 0
+    db.delete_db()
+
+def test_packed_vargs(monkeypatch):
+    import redisk.core
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    values = OrderedDict()
+    values['c'] = np.random.rand(3, 2)
+    values['f'] = np.asfortranarray(np.random.rand(4, 3))
+    values['scalar'] = np.array(5, dtype=np.int16)
+    values['struct'] = np.zeros(3, dtype=[('a', '<i4'), ('b', '<f8')])
+    values['ints'] = [1, 2, 3]
+    values['floats'] = [1.5, 2.5]
+    for key, value in values.items():
+        db.set(key, value)
+    # NumPy and list vargs are packed and read back without a JSON parse
+    class NoLoads(object):
+        dumps = staticmethod(ujson.dumps)
+        def loads(self, value):
+            raise AssertionError('Vargs were parsed as JSON!')
+    monkeypatch.setattr(redisk.core, 'ujson', NoLoads())
+    for key, value in values.items():
+        metadata = tbl.store.get(join('test', key))
+        assert metadata[2] & redisk.core.FLAG_PACKED_VARGS, 'Vargs were not packed!'
+        if isinstance(value, list): assert db.get(key) == value
+        else: np.testing.assert_array_equal(db.get(key), value, 'Arrays are not equal!')
+    assert db.get('f').flags.f_contiguous
+    assert tbl.get('c')[4] == ['<f8', [3, 2], 'C']
+    assert tbl.get('ints')[4] == ['2', 3]
+    monkeypatch.undo()
+
+    # binary records with JSON vargs of earlier versions still decode
+    start, length = tbl.get('c')[:2]
+    header = redisk.core.metadata_header.pack(1, 4, redisk.core.FLAG_VARGS, start, length)
+    tbl.store.set(join('test', 'c'), header + b'["<f8",[3,2],"C"]')
+    np.testing.assert_array_equal(db.get('c'), values['c'], 'Arrays are not equal!')
+    db.delete_db()
+
+def test_cache():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl, cache_bytes=1 << 20, cache_admission={np.ndarray: 100})
+
+    key = str(uuid4())
+    db.set(key, [1, 2, 3])
+    assert db.get(key) == [1, 2, 3]
+    value = db.get(key)
+    value.append(4)
+    assert db.get(key) == [1, 2, 3], 'Cached value was changed by the caller!'
+    assert db.cache_stats()['hits']['value'] == 2
+
+    db.set(key, 'new')
+    assert db.get(key) == 'new', 'Cache was not invalidated on set!'
+    assert db.batched_get([key, key]) == ['new', 'new']
+
+    # arrays above the admission limit only cache their metadata
+    big = str(uuid4())
+    db.set(big, np.random.rand(100))
+    db.get(big)
+    db.get(big)
+    assert ('value', big) not in db.cache.entries
+    assert ('metadata', big) in db.cache.entries
+
+    appended = str(uuid4())
+    for i in range(4):
+        db.append(appended, i, 2)
+        db.get(appended)
+    db.flush()
+    assert db.get(appended) == [0, 1, 2, 3], 'Cache was not invalidated on flush!'
+
+    assert db.delete(key)
+    assert db.get(key) is None, 'Cache was not invalidated on delete!'
+
+    # nested containers of cached values are copied as well
+    nested = str(uuid4())
+    db.set(nested, {'a': [1, 2], 'b': {'c': 'd'}})
+    for value in [db.get(nested), db.get(nested), db.batched_get([nested])[0]]:
+        value['a'].append(3)
+        value['b']['c'] = 'e'
+    assert db.get(nested) == {'a': [1, 2], 'b': {'c': 'd'}}, 'Cached value was changed by the caller!'
+
+    # entries are sized by the decoded values, not by their compressed bytes
+    db.set('ints', list(range(200000)))
+    db.set('text', 'a'*(2 << 20), compression='zlib')
+    for key in ['ints', 'text']:
+        db.get(key)
+        assert ('value', key) not in db.cache.entries, 'Value larger than the cache was cached!'
+    assert db.cache_stats()['bytes'] <= 1 << 20
+    db.delete_db()
+
+def test_compression():
+    tbl = Table(name='test', base_dir=base_path, compression='zlib')
+    db = Redisk(tbl)
+
+    expected = ['a'*1000, 3, {'x': 'y'*100}, list(range(100)), ['aa']*100,
+                np.zeros((100, 10)), b'b'*1000, np.arange(100)]
+    keys = [str(uuid4()) for value in expected]
+    for key, value in zip(keys, expected):
+        db.set(key, value)
+    assert tbl.get(keys[0])[1] < 1000, 'Value was not compressed!'
+
+    # per value codecs override the table compression
+    key = str(uuid4())
+    db.set(key, np.random.rand(100), compression='lzma')
+    keys.append(key)
+    expected.append(db.get(key))
+    key = str(uuid4())
+    db.set(key, 'uncompressed', compression='none')
+    keys.append(key)
+    expected.append('uncompressed')
+    assert tbl.get(key)[5] == 0
+
+    for values in [[db.get(key) for key in keys], db.batched_get(keys)]:
+        for value, exp in zip(values, expected):
+            if isinstance(exp, np.ndarray):
+                np.testing.assert_array_equal(value, exp, 'Arrays are not equal!')
+            else:
+                assert value == exp, 'Decompressed value different from the expected value!'
+    db.delete_db()
+
+def test_async():
+    from redisk.aio import AsyncTable, AsyncRedisk
+
+    async def run():
+        tbl = AsyncTable(name='test', base_dir=base_path)
+        db = AsyncRedisk(tbl)
+
+        expected = ['a', 3, {'x': 1}, [1, 2, 3], np.random.rand(3, 2), b'bytes']
+        keys = [str(uuid4()) for value in expected]
+        await db.set_many(list(zip(keys, expected)))
+        await db.set('single', 'value', col='c')
+
+        # many requests in flight at once
+        values = await asyncio.gather(*[db.get(key) for key in keys])
+        batched = await db.batched_get(keys + [str(uuid4())])
+        assert batched[-1] is None, 'Missing keys should yield None!'
+        for value, batched_value, exp in zip(values, batched, expected):
+            if isinstance(exp, np.ndarray):
+                np.testing.assert_array_equal(value, exp, 'Arrays are not equal!')
+                np.testing.assert_array_equal(batched_value, exp, 'Arrays are not equal!')
+            else:
+                assert value == exp and batched_value == exp, 'Async value different from the expected value!'
+        assert await db.get('single', col='c') == 'value'
+        assert ('single', 'c') in [pair async for pair in db.key_col_pairs()]
+        await db.close()
+
+    asyncio.run(run())
+    Redisk(Table(name='test', base_dir=base_path)).delete_db()
+
+def test_flush_interval():
+    import time
+    import subprocess
+    import sys
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    reader = Redisk(Table(name='test', base_dir=base_path))
+    for kwargs in [dict(fsync='interval', fsync_interval=0.2), dict(buffer_size=1 << 20, flush_interval=0.2)]:
+        db = Redisk(Table(name='test', base_dir=base_path, **kwargs))
+        key = str(uuid4())
+        db.set(key, 'value')
+        # published by the flusher without another write
+        deadline = time.time() + 5
+        while reader.get(key) is None and time.time() < deadline:
+            time.sleep(0.05)
+        assert reader.get(key) == 'value', 'Buffered value was not flushed on time!'
+
+    # buffers are flushed when the process exits without close
+    script = """
+import sys
+sys.path.insert(0, {0!r})
+from redisk import Table, Redisk
+db = Redisk(Table(name='test', base_dir={1!r}, buffer_size=1 << 20))
+db.set('at_exit', 'value')
+""".format(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), base_path)
+    subprocess.check_call([sys.executable, '-c', script])
+    assert reader.get('at_exit') == 'value', 'Buffered value was lost at exit!'
+    reader.delete_db()
+
+def test_sync_sealed_segment(monkeypatch):
+    synced = set()
+    fsync = os.fsync
+    def recording_fsync(fd):
+        synced.add(os.fstat(fd).st_ino)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', recording_fsync)
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    for concurrent_writers in [False, True]:
+        tbl = Table(name='test', base_dir=base_path, fsync='interval', fsync_interval=100, concurrent_writers=concurrent_writers)
+        db = Redisk(tbl)
+        db.set('a', 'first')
+        segment_id = tbl.writer.segment_id
+        inode = os.stat(tbl.segment_path(segment_id)).st_ino
+        # another process seals the segment before the metadata of 'a' is synced
+        tbl.seal(segment_id)
+        db.set('b', 'second')
+        assert tbl.writer.segment_id != segment_id
+        assert inode in synced, 'Sealed segment was closed without fsync!'
+        db.flush()
+        assert db.get('a') == 'first' and db.get('b') == 'second'
+        db.delete_db()
+
+def test_compact():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+    db.delete_db()
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+    # a second instance which keeps its handles open during the compaction
+    reader = Redisk(Table(name='test', base_dir=base_path))
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    for key in keys:
+        db.set(key, 'old'*100, col='a')
+    for i, key in enumerate(keys):
+        db.set(key, str(i), col='a')
+        db.set(key, np.arange(i), col='b')
+    for i in range(5):
+        db.append('list', i, 2)
+    db.flush()
+
+    reclaimed = db.compact(group_by='column')
+    assert reclaimed >= repeats*300, 'Dead space was not reclaimed!'
+    assert len(tbl.list_segment_ids()) == 1, 'Old table files were not removed!'
+    for values in [db, reader]:
+        for i, key in enumerate(keys):
+            assert values.get(key, col='a') == str(i)
+            np.testing.assert_array_equal(values.get(key, col='b'), np.arange(i))
+        assert values.get('list') == list(range(5))
+
+    # both instances keep writing into the new file
+    db.set('after', 'compaction')
+    reader.set('reader', 'value')
+    assert reader.get('after') == 'compaction' and db.get('reader') == 'value'
+    assert db.compact() == 0
+    db.delete_db()
+
+def test_online_compaction():
+    import time
+    import threading
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+    for i in range(repeats):
+        db.set(str(i), 'old'*100)
+        db.set(str(i), i)
+    db.flush()
+
+    # the copy of the compaction waits until the writers are done
+    copying = threading.Event()
+    writes_done = threading.Event()
+    read = tbl.read
+    def slow_read(start, length):
+        copying.set()
+        assert writes_done.wait(10)
+        return read(start, length)
+    tbl.read = slow_read
+    compaction = threading.Thread(target=db.compact)
+    compaction.start()
+    assert copying.wait(10)
+    for concurrent_writers in [False, True]:
+        writer = Redisk(Table(name='test', base_dir=base_path, concurrent_writers=concurrent_writers))
+        start = time.time()
+        writer.set('during', str(concurrent_writers))
+        writer.set('0', 'overwritten')
+        writer.flush()
+        assert time.time() - start < 2, 'Writers waited for the compaction!'
+    writes_done.set()
+    compaction.join()
+    tbl.read = read
+
+    assert db.get('during') == 'True' and db.get('0') == 'overwritten'
+    assert [db.get(str(i)) for i in range(1, repeats)] == list(range(1, repeats))
+    db.delete_db()
+
+def test_read_after_compaction():
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    db = Redisk(Table(name='test', base_dir=base_path))
+    keys = [str(i) for i in range(repeats)]
+    for key in keys:
+        db.set(key, 'old'*10)
+        db.set(key, key)
+    db.set('array', np.arange(12).reshape(4, 3))
+    db.flush()
+
+    # the reader looked up the metadata before the compaction of another
+    # process, but never opened the segments it points into
+    for read in [lambda r: r.get(keys[0]), lambda r: r.batched_get(keys), lambda r: r.get('array', index=[1, 2]),
+                 lambda r: r.parallel_batched_get(keys, threads=2, min_batch_size=2)]:
+        reader = Redisk(Table(name='test', base_dir=base_path), cache_bytes=1 << 20)
+        reader.get_metadata_many(keys + ['array'])
+        reader.tbl.close_segments()
+        db.set('dead', 'x'*100)
+        assert db.compact() > 0
+        value = read(reader)
+        assert value is not None, 'Read failed after the compaction!'
+    assert reader.batched_get(keys) == keys
+    np.testing.assert_array_equal(reader.get('array', index=[1, 2]), np.arange(12).reshape(4, 3)[1:3])
+    db.delete_db()
+
+def test_segments():
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    tbl = Table(name='test', base_dir=base_path, segment_size=100, use_mmap='sealed')
+    db = Redisk(tbl)
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    for i, key in enumerate(keys):
+        db.set(key, str(i)*40)
+    db.set_many([(key + '/b', np.arange(20)) for key in keys])
+    segments = tbl.segments()
+    assert len(segments) > 1, 'Writes did not roll over to new segments!'
+    assert all([sealed for segment_id, size, sealed in segments[:-1]]) and not segments[-1][2]
+    assert all([size <= 160 for segment_id, size, sealed in segments]), 'Segment is larger than its cap!'
+    for values in [[db.get(key) for key in keys], db.batched_get(keys)]:
+        assert values == [str(i)*40 for i in range(repeats)]
+    assert type(db.get(keys[0] + '/b').base) != bytes, 'Sealed segments should be memory mapped!'
+
+    # overwrite the values of the first segments and compact them one at a time
+    first = [segment_id for segment_id, size, sealed in segments[:3]]
+    for i, key in enumerate(keys):
+        db.set(key, i)
+    for segment_id in first:
+        assert db.compact(segment_ids=[segment_id]) > 0
+    assert not any([segment_id in first for segment_id in tbl.segment_ids()]), 'Compacted segments were not removed!'
+    assert [db.get(key) for key in keys] == list(range(repeats))
+    for key in keys:
+        np.testing.assert_array_equal(db.get(key + '/b'), np.arange(20))
+    db.delete_db()
+
+def concurrent_writer(worker):
+    tbl = Table(name='test', base_dir=base_path, concurrent_writers=True)
+    db = Redisk(tbl)
+    for i in range(50):
+        db.set('{0}_{1}'.format(worker, i), i)
+    db.set_many([('{0}_many_{1}'.format(worker, i), str(i)) for i in range(50)])
+    db.close()
+
+def test_concurrent_writers():
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+
+    processes = [multiprocessing.Process(target=concurrent_writer, args=(worker,)) for worker in range(4)]
+    for p in processes: p.start()
+    for p in processes: p.join()
+    assert all([p.exitcode == 0 for p in processes])
+
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+    assert len(tbl.segment_ids()) >= 4, 'Every writer should have its own segment!'
+    for worker in range(4):
+        assert db.batched_get(['{0}_{1}'.format(worker, i) for i in range(50)]) == list(range(50))
+        assert db.batched_get(['{0}_many_{1}'.format(worker, i) for i in range(50)]) == [str(i) for i in range(50)]
+    db.compact()
+    assert db.get('3_49') == 49
+    db.delete_db()
+
+def test_concurrent_writer_compaction():
+    import threading
+    from redisk.util import unpack_offset
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    tbl = Table(name='test', base_dir=base_path, segment_size=100, concurrent_writers=True)
+    db = Redisk(tbl)
+    other = Table(name='test', base_dir=base_path)
+    publish = tbl.set_many
+    threads = []
+
+    def compact_before_publish(metadata):
+        # the write rolled over to a new segment; a compaction of that segment
+        # has to wait until the metadata is published
+        segment_ids = sorted(set([unpack_offset(m[1])[0] for m in metadata]))
+        assert len(segment_ids) == 2
+        t = threading.Thread(target=other.compact, args=(segment_ids[1:],))
+        t.start()
+        t.join(0.5)
+        assert t.is_alive(), 'Compaction did not wait for the writer!'
+        threads.append(t)
+        publish(metadata)
+    tbl.set_many = compact_before_publish
+    db.set_many([('a', 'x'*80), ('b', 'y'*80)])
+    tbl.set_many = publish
+    for t in threads: t.join()
+    assert db.get('a') == 'x'*80 and db.get('b') == 'y'*80
+    db.delete_db()
+
+def mixed_writer(args):
+    worker, concurrent_writers, ready = args
+    db = Redisk(Table(name='test', base_dir=base_path, concurrent_writers=concurrent_writers))
+    if concurrent_writers:
+        # claims the newest segment before the regular writer picks one
+        db.set('{0}_claim'.format(worker), 0)
+        ready.set()
+    ready.wait()
+    for i in range(1000):
+        db.set('{0}_{1}'.format(worker, i), str(i)*(i % 50 + 1))
+    db.close()
+
+def test_mixed_writers():
+    tbl = Table(name='test', base_dir=base_path)
+    Redisk(tbl).delete_db()
+    ready = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=mixed_writer, args=((worker, worker == 0, ready),)) for worker in range(2)]
+    for p in processes: p.start()
+    for p in processes: p.join()
+    assert all([p.exitcode == 0 for p in processes])
+
+    db = Redisk(Table(name='test', base_dir=base_path))
+    for worker in range(2):
+        values = db.batched_get(['{0}_{1}'.format(worker, i) for i in range(1000)])
+        assert values == [str(i)*(i % 50 + 1) for i in range(1000)], 'Writers of both modes wrote into each other!'
+    db.delete_db()
+
 def test_int_handler():
     tbl = Table(name='test', base_dir=base_path)
     db = Redisk(tbl)
@@ -185,6 +933,114 @@ def test_numpy_handler_2D():
         np.testing.assert_array_equal(value, arr, 'Arrays are not equal!')
     db.delete_db()
 
+def test_numpy_dtypes():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    structured = np.zeros(4, dtype=[('id', '<i8'), ('pos', '<f4', (3,)), ('name', 'S5')])
+    structured['id'] = np.arange(4)
+    structured['name'] = b'abc'
+    arrays = [np.arange(12, dtype='>i4').reshape(3, 4), np.asfortranarray(np.random.rand(4, 3)),
+              np.random.rand(5).astype(np.float16), np.array([True, False]), structured,
+              np.array(['a', 'bcd']), np.random.rand(2, 3, 4).astype(np.complex64)]
+    keys = [str(uuid4()) for arr in arrays]
+    for key, arr in zip(keys, arrays):
+        db.set(key, arr)
+    for key, arr, value in zip(keys, arrays, db.batched_get(keys)):
+        for value in [value, db.get(key)]:
+            assert value.dtype == arr.dtype, 'Dtypes are different'
+            assert value.flags.f_contiguous == arr.flags.f_contiguous, 'Memory layout is different'
+            np.testing.assert_array_equal(value, arr, 'Arrays are not equal!')
+    db.delete_db()
+
+def test_array_slice():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    arr = np.random.rand(100, 8).astype(np.float32)
+    db.set('embeddings', arr)
+    db.set('embeddings', arr, col='compressed', compression='zlib')
+    db.set('embeddings', np.asfortranarray(arr), col='fortran')
+    for col in [None, 'compressed', 'fortran']:
+        for rows in [5, -1, slice(10, 20), slice(90, None), slice(0, 50, 7), [3, 4, 99, 3, -2], np.array([], dtype=np.int64)]:
+            np.testing.assert_array_equal(db.get_array_slice('embeddings', rows, col), arr[rows], 'Rows are not equal!')
+    np.testing.assert_array_equal(db.get('embeddings', index=slice(2, 4)), arr[2:4], 'Rows are not equal!')
+    with pytest.raises(IndexError):
+        db.get_array_slice('embeddings', 100)
+
+    # boolean masks select rows like in NumPy, whatever the layout
+    mask = np.arange(100) % 3 == 0
+    db.set('small', np.arange(12).reshape(4, 3))
+    np.testing.assert_array_equal(db.get('small', index=[True, False, True, False]), np.arange(12).reshape(4, 3)[[0, 2]])
+    for col in [None, 'compressed', 'fortran']:
+        for rows in [mask, list(mask), np.zeros(100, dtype=bool)]:
+            np.testing.assert_array_equal(db.get_array_slice('embeddings', rows, col), arr[np.asarray(rows)], 'Rows are not equal!')
+        with pytest.raises(IndexError):
+            db.get_array_slice('embeddings', [True, False], col)
+    db.delete_db()
+
+def test_get_column():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    keys = [str(uuid4()) for i in range(repeats)]
+    arrays = np.random.rand(repeats, 3, 2)
+    for i, key in enumerate(keys):
+        db.set(key, i, col='label')
+        db.set(key, arrays[i], col='features', compression='zlib' if i % 2 == 0 else None)
+        db.set(key, np.asfortranarray(arrays[i]), col='fortran')
+        db.set(key, np.random.rand(i + 1), col='ragged')
+        db.set(key, str(i), col='name')
+
+    labels = db.get_column(keys, 'label')
+    assert labels.dtype == np.int64, 'Int column was not stacked!'
+    np.testing.assert_array_equal(labels, np.arange(repeats), 'Columns are not equal!')
+    for col in ['features', 'fortran']:
+        features = db.get_column(keys, col)
+        assert features.shape == (repeats, 3, 2), 'Array column was not stacked!'
+        np.testing.assert_array_equal(features, arrays, 'Columns are not equal!')
+    assert [len(value) for value in db.get_column(keys, 'ragged')] == list(range(1, repeats + 1))
+    assert db.get_column(keys, 'name') == [str(i) for i in range(repeats)]
+    assert db.get_column(keys + [str(uuid4())], 'label') == list(range(repeats)) + [None]
+    assert len(db.get_column([], 'label')) == 0
+    db.delete_db()
+
+def test_bytes_handler():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    for i in range(repeats):
+        expected = os.urandom(16)
+        key = str(uuid4())
+        db.set(key, expected)
+        value = db.get(key)
+        assert type(value) == bytes, 'Types are different'
+        assert value == expected, 'Bytes value from redisk different from the expected value!'
+    db.delete_db()
+
+def test_mmap():
+    tbl = Table(name='test', base_dir=base_path, use_mmap=True)
+    db = Redisk(tbl)
+
+    for arr in np.random.rand(repeats, 10, 5):
+        key = str(uuid4())
+        db.set(key, arr)
+        # every set grows the file, so every get has to remap
+        value = db.get(key)
+        np.testing.assert_array_equal(value, arr, 'Arrays are not equal!')
+        assert not value.flags.writeable, 'Arrays from a mapped table should be read-only views!'
+
+    key = str(uuid4())
+    db.set(key, b'abc')
+    value = db.get(key)
+    assert type(value) == memoryview, 'Bytes from a mapped table should be memoryviews!'
+    assert value == b'abc'
+
+    key = str(uuid4())
+    db.set(key, 'abc')
+    assert db.get(key) == 'abc'
+    db.delete_db()
+
 def test_dict_list_handler():
     tbl = Table(name='test', base_dir=base_path)
     db = Redisk(tbl)
@@ -241,6 +1097,30 @@ def test_append():
             assert x1 == x2, 'Int value from redisk different from the expected value!'
     db.delete_db()
 
+def test_list_slices():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    # ints and floats are buffered in typed arrays and flushed by size
+    expected = {'ints': list(range(-50, 50)), 'floats': [i/4 for i in range(37)],
+                'strings': [str(uuid4()) for i in range(23)]}
+    for key, values in expected.items():
+        for value in values:
+            db.append(key, value, 1000, 64)
+    db.set('legacy', list(range(10)))
+    expected['legacy'] = list(range(10))
+    db.close()
+
+    assert len(tbl.get('ints')[3]) > 1, 'List was not flushed in chunks!'
+    for key, values in expected.items():
+        assert db.get(key) == values, 'List from redisk different from the expected value!'
+        assert list(db.iter_list(key, prefetch=2)) == values, 'Iterated list different from the expected value!'
+        for start, stop in [(0, None), (3, 17), (5, 6), (-9, None), (10, 3), (0, 1000)]:
+            assert db.get_slice(key, start, stop) == values[start:stop], 'List slice different from the expected value!'
+    assert db.get_slice(str(uuid4()), 0, 1) is None
+    db.delete_db()
+
+
 def test_references():
     tbl = Table(name='test', base_dir=base_path)
     db = Redisk(tbl)
@@ -270,6 +1150,17 @@ def test_references():
         assert db.get_reference(key1) == ref, 'Wrong reference!'
         assert db.get_reference(key2) == ref, 'Wrong reference!'
         assert db.get_reference(key3) == ref, 'Wrong reference!'
+    assert db.count() == 3*repeats, 'References are registered as keys!'
+
+    # groups and references written by older versions
+    ref = str(uuid4())
+    db.set('legacy1', 1)
+    db.set('legacy2', 2)
+    db.set(join('references', ref), ['legacy1'])
+    db.set(join('legacy1', 'reference'), ref)
+    db.set('new', 3, reference_id=ref)
+    assert db.get_with_reference(ref) == [1, 3]
+    assert db.get_reference('legacy1') == ref and db.get_reference('new') == ref
     db.delete_db()
 
 
@@ -307,3 +1198,42 @@ def test_key_iter():
         count += 1 if (key in keys and col in cols and value in values) else 0
     assert count == 10
     db.delete_db()
+
+def test_key_registry():
+    tbl = Table(name='test', base_dir=base_path)
+    db = Redisk(tbl)
+
+    db.set('a1', 'x')
+    db.set('a1', 'y', col='c1')
+    db.set('a2', 'x', col='c1')
+    db.set('a2', 'x', col='c1')
+    db.set_many([('b1/c2', 1), ('b2', 2)])
+    for i in range(5):
+        db.append('list', i, 2)
+    db.sadd('set', 1)
+    db.close()
+
+    assert list(db.keys()) == ['a1', 'a2', 'b1', 'b2', 'list']
+    assert list(db.keys('a')) == ['a1', 'a2']
+    assert list(tbl.keys(batch_size=2)) == ['a1', 'a2', 'b1', 'b2', 'list']
+    assert list(db.keys_with_column('c1')) == ['a1', 'a2']
+    assert db.columns() == ['c1', 'c2']
+    assert db.count() == 5 and db.count('c1') == 2
+    assert set(db.key_col_pairs()) == set([('a1', None), ('a1', 'c1'), ('a2', 'c1'), ('b1', 'c2'), ('b2', None), ('list', None)])
+
+    db.delete('a1')
+    assert db.count() == 5
+    db.delete('a1', col='c1')
+    db.delete('b1', col='c2')
+    assert list(db.keys()) == ['a2', 'b2', 'list']
+    assert db.columns() == ['c1']
+
+    # tables written before the registry existed
+    expected = set(db.key_col_pairs())
+    for key in tbl.store.scan_iter('test:*'):
+        tbl.store.delete(key)
+    assert db.count() == 0
+    db.rebuild_index()
+    assert set(db.key_col_pairs()) == expected
+    assert db.count() == 3
+    db.delete_db()